@@ -1,3 +1,28 @@
-from django.contrib import admin
+from django.contrib import admin, messages
 
-# Register your models here.
+from django_clone_helper.jobs import enqueue
+from django_clone_helper.models import Artist, CloneJob
+
+
+def clone_selected(modeladmin, request, queryset):
+    """Queue a clone job per selected object, run by the clone_worker command."""
+    jobs = [enqueue(obj) for obj in queryset]
+    modeladmin.message_user(request, f'{len(jobs)} clone job(s) queued.', messages.SUCCESS)
+
+
+clone_selected.short_description = 'Clone selected %(verbose_name_plural)s'
+
+
+@admin.register(CloneJob)
+class CloneJobAdmin(admin.ModelAdmin):
+    list_display = ['pk', 'content_type', 'object_id', 'status', 'progress', 'total', 'created_at', 'finished_at']
+    list_filter = ['status', 'content_type']
+    readonly_fields = [
+        'content_type', 'object_id', 'batch_size', 'status', 'total', 'progress', 'result', 'error',
+        'created_at', 'started_at', 'finished_at',
+    ]
+
+
+@admin.register(Artist)
+class ArtistAdmin(admin.ModelAdmin):
+    actions = [clone_selected]
@@ -0,0 +1,1177 @@
+import operator
+from contextlib import contextmanager
+from functools import partial, reduce
+from itertools import chain
+
+from django.contrib.contenttypes.fields import GenericForeignKey, GenericRelation
+from django.contrib.contenttypes.models import ContentType
+from django.core.exceptions import FieldDoesNotExist, ImproperlyConfigured
+from django.db import IntegrityError, OperationalError, connections, router, transaction
+from django.db.models import ManyToManyField, ManyToManyRel, Model, OuterRef, Q, Subquery, signals
+from django.utils.functional import cached_property
+
+from django_clone_helper.files import delete_copies
+from django_clone_helper.signals import clone_batch_created, clone_finished
+
+from django_clone_helper.utils import (
+    COPY, DEDUPE, SHARE, Batch, CircularDependency, LookUp, Param, chunked, get_defaults, get_lookup_path, select_lookups,
+    toposort,
+)
+
+DEFAULT_BATCH_SIZE = 500
+
+
+def get_relation(model, name):
+    """
+    Return the reverse relation (or generic relation) of ``model`` named ``name``. The plans
+    do not follow forward one_to_one relations, that make_clone accepts: their rows are
+    read from the other model.
+    """
+    try:
+        forward = model._meta.get_field(name)
+    except FieldDoesNotExist:
+        forward = None
+    if forward is not None and forward.concrete and forward.one_to_one:
+        raise ValueError(
+            f'{model._meta.label}.{name} is a forward one_to_one relation, which bulk clones do not support: '
+            f'clone {forward.related_model._meta.label} with its reverse relation instead.'
+        )
+    for field in model._meta.get_fields():
+        if isinstance(field, GenericRelation):
+            if field.name == name:
+                return field
+        elif field.auto_created and not field.concrete and (field.one_to_many or field.one_to_one):
+            if field.get_accessor_name() == name:
+                return field
+    raise ValueError(f'{model._meta.label} has no reverse relation named {name!r}.')
+
+
+def enable_wal(cursor):
+    """
+    Switch the SQLite database of ``cursor`` to WAL mode, in which a read transaction is a
+    snapshot that does not block the writers: with the default rollback journal, it holds a
+    SHARED lock that keeps them from committing until it ends. In-memory databases are left
+    as they are. Raise ImproperlyConfigured when the journal mode cannot be changed.
+    """
+    cursor.execute('PRAGMA journal_mode')
+    if cursor.fetchone()[0] in ('wal', 'memory'):
+        return
+    try:
+        # Needs no other connection to the database, the mode is then kept by the file.
+        cursor.execute('PRAGMA journal_mode=WAL')
+        mode = cursor.fetchone()[0]
+    except OperationalError as error:
+        mode = error
+    if mode != 'wal':
+        raise ImproperlyConfigured(
+            f'The snapshot of a SQLite database needs the WAL journal mode, run "PRAGMA journal_mode=WAL" ({mode}).'
+        )
+
+
+@contextmanager
+def snapshot(using):
+    """
+    A read only transaction of ``using``, all the queries of which see the same snapshot of
+    the database: a repeatable read transaction on PostgreSQL and MySQL, a read transaction
+    in WAL mode on SQLite, see enable_wal(). Inside another transaction, the queries keep
+    its snapshot.
+    """
+    connection = connections[using]
+    started = not connection.in_atomic_block
+    if started and connection.vendor == 'sqlite':
+        with connection.cursor() as cursor:
+            enable_wal(cursor)
+    with transaction.atomic(using=using):
+        if started and connection.vendor in ('postgresql', 'mysql'):
+            with connection.cursor() as cursor:
+                cursor.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY')
+        yield
+
+
+def get_content_fields(model):
+    """Return the fields compared to find an existing row identical to a clone, see DEDUPE."""
+    if model._meta.parents:
+        raise ValueError(f'Cannot deduplicate the rows of {model._meta.label}, that inherits from another model.')
+    return [
+        field for field in model._meta.local_concrete_fields
+        if not field.primary_key and not getattr(field, 'auto_now', False) and not getattr(field, 'auto_now_add', False)
+    ]
+
+
+def find_identical(model, fields, rows, using):
+    """
+    Return, for each of the ``rows`` (tuples of the ``fields`` values), the primary key of an
+    existing row of ``model`` with the same values, or None. The candidates are read with
+    one query and matched on the hash of their values.
+    """
+    conditions = []
+    for index, field in enumerate(fields):
+        values = [row[index] for row in rows]
+        condition = Q(**{f'{field.attname}__in': [value for value in values if value is not None]})
+        if any(value is None for value in values):
+            condition |= Q(**{f'{field.attname}__isnull': True})
+        conditions.append(condition)
+    queryset = model._base_manager.using(using).filter(*conditions).order_by('pk')
+    existing = {}
+    for pk, *values in queryset.values_list('pk', *[field.attname for field in fields]).iterator():
+        existing.setdefault(tuple(values), pk)
+    return [existing.get(tuple(row)) for row in rows]
+
+
+def get_many_to_many(model, name):
+    """Return the through model and its source and target field names of a m2m relation."""
+    for field in model._meta.get_fields():
+        if isinstance(field, ManyToManyField) and field.name == name:
+            return field.remote_field.through, field.m2m_field_name(), field.m2m_reverse_field_name()
+        if isinstance(field, ManyToManyRel) and field.get_accessor_name() == name:
+            return field.through, field.field.m2m_reverse_field_name(), field.field.m2m_field_name()
+    raise ValueError(f'{model._meta.label} has no many to many relation named {name!r}.')
+
+
+class InsertStatement:
+    """
+    A parameterised INSERT of ``rows`` rows of ``fields`` of a model, compiled once per
+    (database, model, columns, rows) and reused across batches and clones.
+    """
+    cache = {}
+
+    def __init__(self, model, fields, rows, connection, returning=False):
+        qn = connection.ops.quote_name
+        meta = model._meta
+        columns = ', '.join(qn(field.column) for field in fields)
+        values = connection.ops.bulk_insert_sql(fields, [['%s'] * len(fields)] * rows)
+        self.sql = f'INSERT INTO {qn(meta.db_table)} ({columns}) {values}'
+        if returning:
+            returning_sql, _ = connection.ops.return_insert_columns([meta.pk])
+            self.sql = f'{self.sql} {returning_sql}'
+
+    @classmethod
+    def get(cls, model, fields, rows, connection, returning=False):
+        key = (connection.alias, model, tuple(field.attname for field in fields), rows, returning)
+        if key not in cls.cache:
+            cls.cache[key] = cls(model, fields, rows, connection, returning)
+        return cls.cache[key]
+
+    @staticmethod
+    def is_supported(fields):
+        # Rows without values and fields with custom placeholders (e.g. geometries) go through the ORM.
+        return bool(fields) and all(not hasattr(field, 'get_placeholder') for field in fields)
+
+
+def get_insert_params(objs, fields, connection):
+    return [
+        [field.get_db_prep_save(field.pre_save(obj, True), connection=connection) for field in fields]
+        for obj in objs
+    ]
+
+
+def execute_inserts(model, params, fields, connection, batch_size, returning=False):
+    """
+    Insert the rows of ``params`` with the cached statements: full batches through one
+    ``executemany`` call, or one ``execute`` each when the primary keys are returned.
+    Return the returned rows.
+    """
+    rows = connection.ops.bulk_batch_size(fields, params)
+    rows = max(min(rows, batch_size or rows), 1)
+    batches = [list(chain.from_iterable(params[i:i + rows])) for i in range(0, len(params), rows)]
+    returned = []
+    with connection.cursor() as cursor:
+        full = [batch for batch in batches if len(batch) == rows * len(fields)]
+        rest = batches[len(full):]
+        if full and not returning:
+            cursor.executemany(InsertStatement.get(model, fields, rows, connection).sql, full)
+        else:
+            for batch in full:
+                cursor.execute(InsertStatement.get(model, fields, rows, connection, returning).sql, batch)
+                returned.extend(connection.ops.fetch_returned_insert_rows(cursor))
+        for batch in rest:
+            statement = InsertStatement.get(model, fields, len(batch) // len(fields), connection, returning)
+            cursor.execute(statement.sql, batch)
+            if returning:
+                returned.extend(connection.ops.fetch_returned_insert_rows(cursor))
+    return returned
+
+
+def insert_params(model, fields, params, using, batch_size=None):
+    """
+    Insert the rows of ``params``, the prepared values of ``fields`` of a model without
+    parents, and return the primary keys generated by the database (None when ``fields``
+    include the primary key). The database must return them or be SQLite.
+    """
+    meta = model._meta
+    connection = connections[using]
+    if meta.pk in fields:
+        execute_inserts(model, params, fields, connection, batch_size)
+        return None
+    if connection.features.can_return_rows_from_bulk_insert:
+        returned = execute_inserts(model, params, fields, connection, batch_size, returning=True)
+        return [meta.pk.to_python(pk) for pk, in returned]
+    with transaction.atomic(using=using, savepoint=False):
+        execute_inserts(model, params, fields, connection, batch_size)
+        # SQLite holds the write lock until commit and AUTOINCREMENT keys only grow:
+        # the newest keys of the table are the ones of this batch, in insertion order.
+        pks = list(model._base_manager.using(using).order_by('-pk').values_list('pk', flat=True)[:len(params)])
+    return pks[::-1]
+
+
+def can_insert_params(model, using):
+    """Whether the rows of ``model`` can be inserted by insert_params."""
+    meta = model._meta
+    connection = connections[using]
+    fields = [field for field in meta.local_concrete_fields if field is not meta.pk]
+    if meta.parents or not InsertStatement.is_supported(fields):
+        return False
+    return connection.features.can_return_rows_from_bulk_insert or connection.vendor == 'sqlite'
+
+
+def save_without_signals(obj, using, force_insert=False):
+    """Save ``obj`` like ``save()`` does, without sending ``pre_save`` and ``post_save``."""
+    cls = obj._meta.concrete_model
+    with transaction.atomic(using=using, savepoint=False):
+        parent_inserted = obj._save_parents(cls, using, None)
+        obj._save_table(cls=cls, force_insert=force_insert or parent_inserted, using=using)
+    obj._state.db = using
+    obj._state.adding = False
+    return obj
+
+
+def insert(model, objs, using, batch_size=None, send_signals=True):
+    """
+    Insert ``objs`` in bulk and set their primary keys. The rows that cannot be inserted
+    in bulk are saved one by one, sending their signals unless ``send_signals`` is False.
+    """
+    meta = model._meta
+    connection = connections[using]
+    manager = model._base_manager.db_manager(using)
+    save = partial(model.save if send_signals else save_without_signals, using=using)
+    if meta.parents:
+        # bulk_create() does not support multi-table inheritance.
+        for obj in objs:
+            save(obj, force_insert=True)
+        return objs
+    if not objs:
+        return objs
+    for obj in objs:
+        if obj.pk is None:
+            obj.pk = meta.pk.get_pk_value_on_save(obj)
+    fields = meta.local_concrete_fields
+    if all(obj.pk is not None for obj in objs):
+        if not InsertStatement.is_supported(fields):
+            return manager.bulk_create(objs, batch_size=batch_size)
+        insert_params(model, fields, get_insert_params(objs, fields, connection), using, batch_size)
+    elif all(obj.pk is None for obj in objs) and can_insert_params(model, using):
+        fields = [field for field in fields if field is not meta.pk]
+        pks = insert_params(model, fields, get_insert_params(objs, fields, connection), using, batch_size)
+        for obj, pk in zip(objs, pks):
+            obj.pk = pk
+    elif connection.features.can_return_rows_from_bulk_insert:
+        return manager.bulk_create(objs, batch_size=batch_size)
+    elif connection.vendor == 'sqlite' and all(obj.pk is None for obj in objs):
+        with transaction.atomic(using=using, savepoint=False):
+            manager.bulk_create(objs, batch_size=batch_size)
+            pks = list(manager.order_by('-pk').values_list('pk', flat=True)[:len(objs)])
+        for obj, pk in zip(objs, reversed(pks)):
+            obj.pk = pk
+        return objs
+    else:
+        for obj in objs:
+            save(obj, force_insert=True)
+        return objs
+    for obj in objs:
+        obj._state.adding = False
+        obj._state.db = using
+    return objs
+
+
+def find_conflicts(objs, fields, using):
+    """Return the indexes of the ``objs`` whose value of a unique field is already taken."""
+    conflicts = set()
+    for field in fields:
+        values = [getattr(obj, field.attname) for obj in objs]
+        manager = field.model._base_manager.db_manager(using)
+        taken = set(manager.filter(**{f'{field.attname}__in': values}).values_list(field.attname, flat=True))
+        for index, value in enumerate(values):
+            if value in taken:
+                conflicts.add(index)
+            taken.add(value)
+    return sorted(conflicts)
+
+
+def insert_optimistic(model, objs, originals, using, save, retries):
+    """
+    Run ``save(objs)`` in a savepoint. On a unique violation, only the conflicting ``objs`` are
+    reset to their ``originals`` unique values, made unique again and retried, at most
+    ``retries`` times.
+    """
+    handler = model.clone
+    fields = model._meta.concrete_fields
+    for attempt in range(retries + 1):
+        states = [({field.attname: getattr(obj, field.attname) for field in fields}, obj._state.adding) for obj in objs]
+        try:
+            with transaction.atomic(using=using):
+                return save(objs)
+        except IntegrityError:
+            for obj, (values, adding) in zip(objs, states):
+                obj.__dict__.update(values)
+                obj._state.adding = adding
+            conflicts = find_conflicts(objs, handler.get_unique_fields(model), using)
+            if attempt == retries or not conflicts:
+                raise
+        for index in conflicts:
+            objs[index].__dict__.update(originals[index])
+            handler._set_unique_constrain(objs[index], using=using)
+
+
+class CloneResult:
+    """Source to clone primary keys of every row written by a bulk clone, per concrete model."""
+
+    def __init__(self, using=None):
+        self.using = using
+        self.mapping = {}
+        # Existing rows standing for the deduplicated source rows, left alone by undo_clone.
+        self.reused = {}
+
+    def add(self, model, source_pk, clone_pk):
+        for klass in [model, *model._meta.get_parent_list()]:
+            self.mapping.setdefault(klass._meta.concrete_model, {})[source_pk] = clone_pk
+
+    def reuse(self, model, source_pk, pk):
+        self.reused.setdefault(model._meta.concrete_model, {})[source_pk] = pk
+
+    def get(self, model, source_pk, default=None):
+        model = model._meta.concrete_model
+        pk = self.mapping.get(model, {}).get(source_pk)
+        return self.reused.get(model, {}).get(source_pk, default) if pk is None else pk
+
+    def get_clone(self, instance, using=None):
+        model = instance._meta.concrete_model
+        return model._base_manager.db_manager(using).get(pk=self.get(model, instance.pk))
+
+    @property
+    def counts(self):
+        return {model._meta.label: len(pks) for model, pks in self.mapping.items()}
+
+
+def get_through_links(model, cloned=()):
+    """
+    Return the ``(through model, field name)`` of the m2m rows pointing to ``model``, auto
+    created or not. The through models in ``cloned`` are left out, their rows are clones
+    deleted with the other ones.
+    """
+    links = []
+    for field in model._meta.get_fields():
+        if isinstance(field, ManyToManyField):
+            links.append((field.remote_field.through, field.m2m_field_name()))
+        elif isinstance(field, ManyToManyRel):
+            links.append((field.through, field.field.m2m_reverse_field_name()))
+    return [(through, name) for through, name in links if through._meta.concrete_model not in cloned]
+
+
+def undo_clone(result, using=None, batch_size=DEFAULT_BATCH_SIZE, send_signals=True):
+    """
+    Delete the clones recorded in ``result`` with one DELETE per batch of primary keys, each
+    model before the models it points to, instead of going through the deletion Collector.
+    The nullable foreign keys of the dependency cycles are set to null first. ``pre_delete``
+    and ``post_delete`` are sent for every row, unless ``send_signals`` is False: the rows are
+    then deleted without being read. Return the number of deleted rows per model label.
+    """
+    models = list(result.mapping)
+    if not models:
+        return {}
+    using = using or result.using or router.db_for_write(models[0])
+    links = {
+        model: [
+            field for field in model._meta.concrete_fields
+            if field.is_relation and field.related_model._meta.concrete_model in result.mapping
+        ]
+        for model in models
+    }
+    nulled = {field for model in models for field in links[model] if field.related_model is model and field.null}
+
+    def deleted_after(a, b):
+        return any(field.related_model._meta.concrete_model is a for field in links[b] if field not in nulled)
+
+    while True:
+        try:
+            models = toposort(models, deleted_after)
+            break
+        except CircularDependency as error:
+            cycle = error.items
+        fields = [
+            field for model in cycle for field in links[model]
+            if field.null and field not in nulled and field.related_model._meta.concrete_model in cycle
+        ]
+        if not fields:
+            raise ValueError(f'Cannot break the dependency cycle between {cycle!r}: no nullable foreign key.')
+        nulled.add(fields[0])
+
+    counts = {}
+    with transaction.atomic(using=using):
+        for field in nulled:
+            manager = field.model._base_manager.using(using)
+            for pks in chunked(result.mapping[field.model._meta.concrete_model].values(), batch_size):
+                manager.filter(pk__in=pks).update(**{field.attname: None})
+        for model in models:
+            manager = model._base_manager.using(using)
+            for pks in chunked(result.mapping[model].values(), batch_size):
+                for through, name in get_through_links(model, result.mapping):
+                    through._base_manager.using(using).filter(**{f'{name}__in': pks})._raw_delete(using)
+                objs = list(manager.filter(pk__in=pks)) if send_signals else []
+                for obj in objs:
+                    signals.pre_delete.send(sender=model, instance=obj, using=using)
+                deleted = manager.filter(pk__in=pks)._raw_delete(using)
+                for obj in objs:
+                    signals.post_delete.send(sender=model, instance=obj, using=using)
+                counts[model._meta.label] = counts.get(model._meta.label, 0) + deleted
+    return counts
+
+
+class Columns:
+    """
+    The staged clones of a batch of one model: one list of values per concrete field
+    (keyed by attname), instead of one model instance per row.
+    """
+    __slots__ = ('model', 'source_pks', 'values')
+
+    def __init__(self, model, source_pks, values):
+        self.model = model
+        self.source_pks = source_pks
+        self.values = values
+
+    def __len__(self):
+        return len(self.source_pks)
+
+    def instances(self):
+        """Build the model instances of the rows, for the callers that need them."""
+        names = list(self.values)
+        return [self.model(**dict(zip(names, row))) for row in zip(*self.values.values())]
+
+
+class PlanNode:
+    """A declared relation of the subtree: the rows of ``model`` related to the parent node rows."""
+
+    def __init__(
+            self, handler, param, parent=None, one_to_one=None, many_to_one=None, many_to_many=None, recursive=False
+    ):
+        self.handler = handler
+        self.model = handler.owner
+        self.param = param
+        self.parent = parent
+        self.relation = None if parent is None else get_relation(parent.model, param.name)
+        # A self-referential relation: its rows are the descendants of the model rows,
+        # the relations of which are declared by the parent node.
+        self.recursive = recursive
+        self.many_to_many = many_to_many or handler.many_to_many
+        self.children = []
+        if recursive or param.policy != COPY:
+            return
+        for child_param in [*(one_to_one or handler.one_to_one), *(many_to_one or handler.many_to_one)]:
+            if child_param.policy == SHARE:
+                continue
+            relation = get_relation(self.model, child_param.name)
+            child_model = relation.related_model
+            recursive = child_model is self.model and not isinstance(relation, GenericRelation)
+            if not recursive and any(node.model is child_model for node in self.ancestors):
+                raise ValueError(f'Only self-referential clone declarations can be recursive ({child_model._meta.label}).')
+            self.children.append(PlanNode(handler.spawn(child_model), child_param, parent=self, recursive=recursive))
+
+    @property
+    def ancestors(self):
+        node = self
+        while node is not None:
+            yield node
+            node = node.parent
+
+    def condition(self, parents):
+        """Return the filter of the rows related to the ``parents`` queryset, restricted by the param."""
+        if isinstance(self.relation, GenericRelation):
+            content_type = ContentType.objects.db_manager(parents.db).get_for_model(
+                self.parent.model, for_concrete_model=self.relation.for_concrete_model
+            )
+            link = {
+                self.relation.content_type_field_name: content_type,
+                f'{self.relation.object_id_field_name}__in': parents.values('pk'),
+            }
+            partition = [self.relation.content_type_field_name, self.relation.object_id_field_name]
+        else:
+            link = {f'{self.relation.field.name}__in': parents.values('pk')}
+            partition = [self.relation.field.name]
+        condition = Q(**link) & self.param.condition
+        if self.param.limit is not None:
+            # Keep the first rows of each parent.
+            kept = self.model._default_manager.filter(self.param.condition, **{
+                name: OuterRef(name) for name in partition
+            })
+            kept = kept.order_by(*self.param.order_by or ['pk']).values('pk')[:self.param.limit]
+            condition &= Q(pk__in=Subquery(kept))
+        return condition
+
+
+class PlanModel:
+    """
+    All the rows of one model in the subtree, whatever relations they are reached by:
+    they are read, written and linked once, after the models they depend on.
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self.nodes = []
+        self.edges = []
+        self.deferred = []
+        self.level = 0
+
+    def __repr__(self):
+        return f'<PlanModel {self.model._meta.label}>'
+
+    @property
+    def dependencies(self):
+        """The models that must be written before this one."""
+        return [model for model, field in self.edges if field not in self.deferred and model is not self]
+
+    @property
+    def handler(self):
+        return self.nodes[0].handler
+
+    @cached_property
+    def param(self):
+        """The params of all the nodes, merged in plan order: the first declaration of an attr wins."""
+        attrs, exclude = {}, []
+        for node in self.nodes:
+            for name, value in node.param.attrs.items():
+                attrs.setdefault(name, value)
+            exclude.extend(node.param.exclude or [])
+        return Param(name=None, attrs=attrs, exclude=exclude)
+
+    @cached_property
+    def policy(self):
+        policies = {node.param.policy for node in self.nodes}
+        if len(policies) > 1:
+            raise ValueError(f'The relations to {self.model._meta.label} have different policies.')
+        return policies.pop()
+
+    @cached_property
+    def only(self):
+        """The fields to read, or an empty list when one of the relations reads them all."""
+        only = [node.param.get_only(self.model) for node in self.nodes]
+        return [] if not all(only) else sorted(set().union(*only))
+
+    @cached_property
+    def defaults(self):
+        """The attnames of the fields left out by ``only``, that get their default value."""
+        return get_defaults(self.model, self.only)
+
+    @cached_property
+    def many_to_many(self):
+        params = {}
+        for node in self.nodes:
+            for param in node.many_to_many:
+                params.setdefault(param.name, param)
+        return list(params.values())
+
+    @property
+    def fixed(self):
+        """Attributes overridden by the param, that must not be remapped."""
+        return {name for name in self.param.attrs if name not in self.param.exclude}
+
+    def get_edges(self, models):
+        """
+        Return the ``(PlanModel, field)`` pairs of the ``models`` this model rows point to,
+        the field being None for generic relations.
+        """
+        edges = []
+        for node in self.nodes:
+            if isinstance(node.relation, GenericRelation):
+                edges.append((models[node.parent.model._meta.concrete_model], None))
+        for field in self.model._meta.concrete_fields:
+            if field.is_relation and not field.remote_field.parent_link:
+                model = field.related_model._meta.concrete_model
+                if model in models:
+                    edges.append((models[model], field))
+        return edges
+
+    def defer(self, field):
+        if not field.null:
+            raise ValueError(f'Cannot clone the cyclic relation {field} that is not nullable.')
+        self.deferred.append(field)
+
+
+class ClonePlan:
+    """
+    The subtree declared by a CloneHandler and its related handlers, as a list of
+    PlanModel sorted so that every model comes after the models it depends on.
+    """
+
+    def __init__(self, handler, many_to_one=None, one_to_one=None, many_to_many=None, exclude=None, attrs=None):
+        self.root = PlanNode(
+            handler,
+            Param(name=None, attrs=attrs, exclude=exclude),
+            one_to_one=one_to_one,
+            many_to_one=many_to_one,
+            many_to_many=many_to_many,
+        )
+        models = {}
+        for node in self.nodes:
+            model = node.model._meta.concrete_model
+            models.setdefault(model, PlanModel(node.model)).nodes.append(node)
+        for plan_model in models.values():
+            plan_model.edges = plan_model.get_edges(models)
+            for model, field in plan_model.edges:
+                if model is plan_model:
+                    plan_model.defer(field)
+        self.models = self.sort(list(models.values()))
+        for plan_model in self.models:
+            plan_model.level = max((model.level + 1 for model in plan_model.dependencies), default=0)
+
+    @staticmethod
+    def sort(models):
+        """Sort the models by dependency, deferring nullable foreign keys to break the cycles."""
+        while True:
+            try:
+                return toposort(models, lambda a, b: b in a.dependencies)
+            except CircularDependency as error:
+                cycle = error.items
+            for plan_model in cycle:
+                fields = [field for model, field in plan_model.edges if model in cycle and field not in plan_model.deferred]
+                fields = [field for field in fields if field is not None and field.null]
+                if fields:
+                    plan_model.defer(fields[0])
+                    break
+            else:
+                raise ValueError(f'Cannot break the dependency cycle between {cycle!r}: no nullable foreign key.')
+
+    @property
+    def nodes(self):
+        nodes = [self.root]
+        while nodes:
+            yield from nodes
+            nodes = [child for node in nodes for child in node.children]
+
+    def __iter__(self):
+        return iter(self.models)
+
+    def __getitem__(self, model):
+        for plan_model in self.models:
+            if plan_model.model._meta.concrete_model is model._meta.concrete_model:
+                return plan_model
+        raise KeyError(model)
+
+
+class BulkWriter:
+    """Remap, make unique and insert staged clones in bulk, recording the source to clone keys."""
+
+    def __init__(
+            self, using, batch_size=DEFAULT_BATCH_SIZE, validate=False, result=None, copy_files=True, batch_signals=False
+    ):
+        self.using = using
+        self.batch_size = batch_size
+        self.validate = validate
+        self.copy_files = copy_files
+        # Send clone_batch_created per written batch, instead of the signals of the saved rows.
+        self.batch_signals = batch_signals
+        self.result = result or CloneResult(using)
+        # The (storage, name) file copies of the written clones, see delete_copies().
+        self.copies = []
+        # Deferred foreign keys, set once every row has been written: {model: (fields, rows)}.
+        self.pending = {}
+
+    def remap(self, obj, fixed=()):
+        """Point the relations of ``obj`` that target a cloned row to its clone."""
+        for field in obj._meta.concrete_fields:
+            if not field.is_relation or field.name in fixed or field.attname in fixed:
+                continue
+            if field.remote_field.parent_link or not field.target_field.primary_key:
+                continue
+            value = getattr(obj, field.attname)
+            setattr(obj, field.attname, self.result.get(field.related_model, value, value))
+        for field in obj._meta.private_fields:
+            if not isinstance(field, GenericForeignKey) or field.fk_field in fixed:
+                continue
+            content_type_id = getattr(obj, obj._meta.get_field(field.ct_field).attname)
+            if content_type_id is None:
+                continue
+            model = ContentType.objects.db_manager(self.using).get_for_id(content_type_id).model_class()
+            value = getattr(obj, field.fk_field)
+            setattr(obj, field.fk_field, self.result.get(model, value, value))
+        return obj
+
+    def accepts_columns(self, model):
+        """
+        Whether the clones of ``model`` can be written from Columns. Validation, unique values
+        and multi-table inheritance work on model instances.
+        """
+        handler = model.clone
+        if self.validate or handler.optimistic or handler.get_unique_fields(model):
+            return False
+        return can_insert_params(model, self.using)
+
+    def remap_columns(self, columns, fixed=()):
+        """Point the relations of the ``columns`` rows that target a cloned row to its clone."""
+        meta = columns.model._meta
+        values = columns.values
+        for field in meta.concrete_fields:
+            if not field.is_relation or field.name in fixed or field.attname in fixed:
+                continue
+            if field.remote_field.parent_link or not field.target_field.primary_key:
+                continue
+            related = field.related_model._meta.concrete_model
+            mapping = {**self.result.reused.get(related, {}), **self.result.mapping.get(related, {})}
+            values[field.attname] = [mapping.get(value, value) for value in values[field.attname]]
+        for field in meta.private_fields:
+            if not isinstance(field, GenericForeignKey) or field.fk_field in fixed:
+                continue
+            content_types = ContentType.objects.db_manager(self.using)
+            values[field.fk_field] = [
+                value if content_type_id is None
+                else self.result.get(content_types.get_for_id(content_type_id).model_class(), value, value)
+                for content_type_id, value in zip(values[meta.get_field(field.ct_field).attname], values[field.fk_field])
+            ]
+        return columns
+
+    def dedupe(self, model, source_pks, rows):
+        """
+        Reuse the existing rows with the same content as the staged ``rows`` (tuples of the
+        get_content_fields values), and the first of the identical rows of the batch for the
+        other ones. Return the indexes of the rows to insert and the ``{source pk: source pk}``
+        of the duplicates of the batch, to record once their first row is inserted.
+        """
+        existing = find_identical(model, get_content_fields(model), rows, self.using)
+        kept, duplicates, first = [], {}, {}
+        for index, (source_pk, row, pk) in enumerate(zip(source_pks, rows, existing)):
+            if pk is not None:
+                self.result.reuse(model, source_pk, pk)
+            elif tuple(row) in first:
+                duplicates[source_pk] = first[tuple(row)]
+            else:
+                first[tuple(row)] = source_pk
+                kept.append(index)
+        return kept, duplicates
+
+    def reuse_duplicates(self, model, duplicates):
+        for source_pk, first in duplicates.items():
+            self.result.reuse(model, source_pk, self.result.get(model, first))
+
+    def write_columns(self, columns, fixed=(), deferred=(), dedupe=False):
+        """Insert the staged ``columns``, like write(), and return the clone primary keys."""
+        model = columns.model
+        meta = model._meta
+        values = columns.values
+        postponed = [dict(zip([field.attname for field in deferred], row)) for row in zip(*(
+            values[field.attname] for field in deferred
+        ))]
+        for field in deferred:
+            values[field.attname] = [None] * len(columns)
+        self.remap_columns(columns, fixed)
+        duplicates = {}
+        if dedupe:
+            rows = list(zip(*(values[field.attname] for field in get_content_fields(model))))
+            kept, duplicates = self.dedupe(model, columns.source_pks, rows)
+            values = {name: [column[index] for index in kept] for name, column in values.items()}
+            columns = Columns(model, [columns.source_pks[index] for index in kept], values)
+            postponed = [postponed[index] for index in kept] if postponed else postponed
+            if not columns:
+                return []
+        if self.copy_files and model.clone.file_copier is not None:
+            model.clone.file_copier.copy_columns(model, values, exclude=fixed, copies=self.copies)
+        connection = connections[self.using]
+        fields = meta.local_concrete_fields
+        if values[meta.pk.attname][:1] == [None]:
+            fields = [field for field in fields if field is not meta.pk]
+        params = list(zip(*(
+            [field.get_db_prep_save(value, connection=connection) for value in values[field.attname]]
+            for field in fields
+        )))
+        pks = insert_params(model, fields, [list(row) for row in params], self.using, self.batch_size)
+        if pks is None:
+            pks = values[meta.pk.attname]
+        for source_pk, clone_pk in zip(columns.source_pks, pks):
+            self.result.add(model, source_pk, clone_pk)
+        self.reuse_duplicates(model, duplicates)
+        self.send_batch(model, pks)
+        if deferred:
+            _, rows = self.pending.setdefault(model, (deferred, []))
+            rows.extend((pk, row) for pk, row in zip(pks, postponed) if any(row.values()))
+        return pks
+
+    def write(self, model, pairs, fixed=(), deferred=(), dedupe=False):
+        """
+        Insert ``(source pk, staged clone)`` pairs of ``model``. The ``deferred`` foreign keys
+        are inserted as null, and set by fix_deferred() once their targets are written. With
+        ``dedupe``, existing rows identical to the clones are reused instead.
+        """
+        handler = model.clone
+        clones, postponed, originals = [], [], []
+        for source_pk, clone in pairs:
+            postponed.append({field.attname: getattr(clone, field.attname) for field in deferred})
+            for field in deferred:
+                setattr(clone, field.attname, None)
+            self.remap(clone, fixed)
+        duplicates = {}
+        if dedupe:
+            fields = get_content_fields(model)
+            rows = [tuple(field.value_from_object(clone) for field in fields) for _, clone in pairs]
+            kept, duplicates = self.dedupe(model, [source_pk for source_pk, _ in pairs], rows)
+            pairs = [pairs[index] for index in kept]
+            postponed = [postponed[index] for index in kept]
+        for source_pk, clone in pairs:
+            originals.append(handler.get_unique_values(clone))
+            handler._set_unique_constrain(clone, using=self.using)
+            if self.validate:
+                clone.full_clean(validate_unique=not handler.optimistic)
+            clones.append(clone)
+        if self.copy_files and handler.file_copier is not None:
+            handler.file_copier(clones, exclude=fixed, copies=self.copies)
+        send_signals = not self.batch_signals
+        if handler.optimistic:
+            save = partial(insert, model, using=self.using, batch_size=self.batch_size, send_signals=send_signals)
+            insert_optimistic(model, clones, originals, self.using, save, handler.unique_retries)
+        else:
+            insert(model, clones, self.using, self.batch_size, send_signals=send_signals)
+        for (source_pk, _), clone in zip(pairs, clones):
+            self.result.add(model, source_pk, clone.pk)
+        self.reuse_duplicates(model, duplicates)
+        self.send_batch(model, [clone.pk for clone in clones])
+        if deferred:
+            _, rows = self.pending.setdefault(model, (deferred, []))
+            rows.extend((clone.pk, values) for clone, values in zip(clones, postponed) if any(values.values()))
+        return clones
+
+    def delete_copies(self):
+        """Delete the file copies of the clones, once their transaction rolled back."""
+        delete_copies(self.copies)
+        self.copies = []
+
+    def send_batch(self, model, pks):
+        if self.batch_signals and pks:
+            clone_batch_created.send(sender=model, pks=list(pks), using=self.using)
+
+    def fix_deferred(self):
+        """Set the deferred foreign keys, with one bulk update per model."""
+        for model, (fields, rows) in self.pending.items():
+            objs = []
+            for clone_pk, values in rows:
+                obj = model(pk=clone_pk)
+                for field in fields:
+                    value = values[field.attname]
+                    setattr(obj, field.attname, self.result.get(field.related_model, value, value))
+                objs.append(obj)
+            model._base_manager.db_manager(self.using).bulk_update(
+                objs, [field.name for field in fields], batch_size=self.batch_size
+            )
+        self.pending = {}
+
+    def link(self, model, name, pairs):
+        """Link the clones of ``model`` to the targets of the ``(source pk, target pk)`` pairs."""
+        through, source_name, target_name = get_many_to_many(model, name)
+        source_field = through._meta.get_field(source_name)
+        target_field = through._meta.get_field(target_name)
+        # Leave out the deduplicated rows, that keep their own links.
+        clones = self.result.mapping.get(model._meta.concrete_model, {})
+        links = [
+            through(**{
+                source_field.attname: clones[source_pk],
+                target_field.attname: self.result.get(target_field.related_model, target_pk, target_pk),
+            })
+            for source_pk, target_pk in pairs if source_pk in clones
+        ]
+        through._base_manager.db_manager(self.using).bulk_create(links, batch_size=self.batch_size)
+
+
+class BulkCloner:
+    """
+    Clone the subtree of a ClonePlan with one read query and one bulk insert per batch
+    of each model, instead of the row by row recursion of ``make_clone``.
+    """
+
+    def __init__(self, plan, roots, batch_size=DEFAULT_BATCH_SIZE, validate=False, progress=None, snapshot=False):
+        self.plan = plan
+        # Stage the whole subtree from one snapshot before writing it, see read().
+        self.snapshot = snapshot
+        # Called with the model and the number of rows after each written batch.
+        self.progress = progress
+        handler = plan.root.handler
+        self.read_using = handler.read_alias
+        self.batch_size = batch_size
+        self.validate = validate
+        self.writer = self.new_writer()
+        self.root_queryset = roots.using(self.read_using)
+        self.closures = {}
+
+    @property
+    def result(self):
+        return self.writer.result
+
+    @cached_property
+    def roots(self):
+        # Freeze the roots, so that clones matching the same filter are never picked up.
+        return list(self.root_queryset.values_list('pk', flat=True))
+
+    def new_writer(self):
+        handler = self.plan.root.handler
+        return BulkWriter(
+            handler.write_alias, batch_size=self.batch_size, validate=self.validate, batch_signals=handler.batch_signals
+        )
+
+    def get_queryset(self, plan_model):
+        queryset = plan_model.model._default_manager.using(self.read_using)
+        conditions = [self.get_condition(node) for node in plan_model.nodes if not node.recursive]
+        queryset = queryset.filter(reduce(operator.or_, conditions))
+        recursive = [node for node in plan_model.nodes if node.recursive]
+        if recursive:
+            return queryset.model._default_manager.using(self.read_using).filter(
+                pk__in=self.get_closure(plan_model, queryset, recursive)
+            )
+        return queryset
+
+    def get_condition(self, node):
+        if node.parent is None:
+            return Q(pk__in=self.roots)
+        return node.condition(self.get_queryset(self.plan[node.parent.model]))
+
+    def get_closure(self, plan_model, queryset, nodes):
+        """
+        Return the primary keys of the ``queryset`` rows and of all their descendants through
+        the self-referential ``nodes``, read at once with a recursive query.
+        """
+        if plan_model not in self.closures and any(node.param.condition or node.param.limit is not None for node in nodes):
+            self.closures[plan_model] = self.walk_closure(plan_model, queryset, nodes)
+        if plan_model not in self.closures:
+            connection = connections[self.read_using]
+            qn = connection.ops.quote_name
+            meta = plan_model.model._meta
+            table, pk = qn(meta.db_table), qn(meta.pk.column)
+            sql, params = queryset.order_by().values('pk').query.get_compiler(connection=connection).as_sql()
+            join = ' OR '.join(f'child.{qn(node.relation.field.column)} = tree.id' for node in nodes)
+            sql = (
+                f'WITH RECURSIVE tree(id) AS ('
+                f'SELECT {pk} FROM {table} WHERE {pk} IN ({sql}) '
+                f'UNION SELECT child.{pk} FROM {table} child JOIN tree ON {join}'
+                f') SELECT id FROM tree'
+            )
+            with connection.cursor() as cursor:
+                cursor.execute(sql, params)
+                self.closures[plan_model] = [row[0] for row in cursor.fetchall()]
+        return self.closures[plan_model]
+
+    def walk_closure(self, plan_model, queryset, nodes):
+        """
+        Like get_closure(), one level of descendants per query, for the ``nodes`` with filters
+        or a limit: they are applied to the children of every level, like make_clone does.
+        """
+        manager = plan_model.model._default_manager.using(self.read_using)
+        pks = list(queryset.values_list('pk', flat=True))
+        seen, level = set(pks), pks
+        while level:
+            parents = manager.filter(pk__in=level)
+            children = manager.filter(reduce(operator.or_, [node.condition(parents) for node in nodes]))
+            level = [pk for pk in children.values_list('pk', flat=True) if pk not in seen]
+            seen.update(level)
+            pks.extend(level)
+        return pks
+
+    def count(self):
+        """Return the number of source rows of each model of the plan."""
+        return {plan_model.model: self.get_queryset(plan_model).count() for plan_model in self.plan}
+
+    def iter_batches(self, plan_model):
+        # Dotted LookUp attrs are joined to the batch query instead of loaded row by row.
+        queryset = select_lookups(self.get_queryset(plan_model), plan_model.param.attrs)
+        if plan_model.only:
+            queryset = queryset.only(*plan_model.only)
+        queryset = queryset.order_by('pk')
+        return chunked(queryset.iterator(chunk_size=self.batch_size), self.batch_size)
+
+    def can_stage_columns(self, plan_model):
+        """Whether the rows of ``plan_model`` can be staged as Columns, see stage_columns."""
+        model = plan_model.model
+        if not self.writer.accepts_columns(model):
+            return False
+        concrete = {name for field in model._meta.concrete_fields for name in (field.name, field.attname)}
+        for name, value in plan_model.param.attrs.items():
+            if name in plan_model.param.exclude:
+                continue
+            # Other attributes (generic foreign keys, properties) are set on instances.
+            if name not in concrete:
+                return False
+            if isinstance(value, LookUp) and get_lookup_path(model, value.name) is None:
+                return False
+            if isinstance(value, Batch) and (value.fields is None or not set(value.fields) <= concrete):
+                return False
+        return True
+
+    def iter_columns(self, plan_model):
+        """Yield the rows of ``plan_model`` by batch, staged as Columns read with ``values_list``."""
+        for values, lookups in self.iter_values(plan_model):
+            yield self.stage_columns(plan_model, values, lookups)
+
+    def iter_values(self, plan_model):
+        """
+        Yield the source rows of ``plan_model`` by batch, as ``({attname: values}, {attr: values})``
+        of their columns and of the LookUp attrs.
+        """
+        meta = plan_model.model._meta
+        only = set(plan_model.only)
+        read = [
+            field for field in meta.concrete_fields
+            if not only or field.primary_key or field.name in only or field.attname in only
+        ]
+        lookups = {
+            name: get_lookup_path(meta.model, value.name) for name, value in plan_model.param.attrs.items()
+            if isinstance(value, LookUp) and name not in plan_model.param.exclude
+        }
+        queryset = self.get_queryset(plan_model).order_by('pk')
+        queryset = queryset.values_list(*[field.attname for field in read], *lookups.values())
+        for rows in chunked(queryset.iterator(chunk_size=self.batch_size), self.batch_size):
+            columns = [list(column) for column in zip(*rows)]
+            yield dict(zip([field.attname for field in read], columns)), dict(zip(lookups, columns[len(read):]))
+
+    def stage_columns(self, plan_model, values, lookups):
+        """
+        Turn the source ``values`` columns into the clone ones, applying the attrs column by
+        column (``lookups`` holding the values of the LookUp attrs); relations still point to
+        source rows, like stage().
+        """
+        model = plan_model.model
+        meta = model._meta
+        source_pks = values[meta.pk.attname]
+        count = len(source_pks)
+        for field in meta.concrete_fields:
+            if field.attname not in values:
+                values[field.attname] = [field.get_default() for _ in range(count)]
+        attrs = {}
+        for name, value in plan_model.param.attrs.items():
+            if name in plan_model.param.exclude:
+                continue
+            # Only concrete fields, see can_stage_columns().
+            field = meta.get_field(name)
+            if isinstance(value, LookUp):
+                column = lookups[name]
+            elif isinstance(value, Batch):
+                names = {name: meta.get_field(name).attname for name in value.fields}
+                column = value.resolve_rows([
+                    {name: values[attname][i] for name, attname in names.items()} for i in range(count)
+                ])
+            elif callable(value):
+                column = [value() for _ in range(count)]
+            else:
+                if field.is_relation and isinstance(value, Model):
+                    value = value.pk
+                column = [value] * count
+            attrs[field.attname] = column
+        values.update(attrs)
+        if not meta.pk.is_relation:
+            default = meta.pk.has_default()
+            values[meta.pk.attname] = [meta.pk.get_default() if default else None for _ in range(count)]
+        for field in meta.concrete_fields:
+            # Like their pre_save() on insert.
+            if getattr(field, 'auto_now', False) or getattr(field, 'auto_now_add', False):
+                values[field.attname] = [field.pre_save(model(), add=True)] * count
+        return Columns(model, source_pks, values)
+
+    def iter_links(self, plan_model, name):
+        """Yield the ``(source pk, target pk)`` pairs of a m2m relation of the model rows."""
+        through, source_name, target_name = get_many_to_many(plan_model.model, name)
+        source_field = through._meta.get_field(source_name)
+        target_field = through._meta.get_field(target_name)
+        queryset = through._base_manager.using(self.read_using).filter(**{
+            f'{source_name}__in': self.get_queryset(plan_model).values('pk'),
+        })
+        queryset = queryset.order_by('pk').values_list(source_field.attname, target_field.attname)
+        return queryset.iterator(chunk_size=self.batch_size)
+
+    def stage(self, plan_model, source, attrs=None):
+        """Copy ``source`` applying the model attrs; relations still point to source rows."""
+        meta = plan_model.model._meta
+        clone = plan_model.handler.clone_instance(
+            source, exclude=plan_model.param.exclude, attrs=attrs or plan_model.param.attrs, commit=False,
+            defaults=plan_model.defaults,
+        )
+        if meta.pk.is_relation and not meta.pk.remote_field.parent_link:
+            setattr(clone, meta.pk.attname, source.pk)
+        for parent in meta.get_parent_list():
+            setattr(clone, parent._meta.pk.attname, None)
+        return clone
+
+    def stage_batch(self, plan_model, sources):
+        """Stage a batch of sources, calling each Batch attribute once for the whole batch."""
+        param = plan_model.param
+        batch_values = {
+            name: value.resolve(sources) for name, value in param.attrs.items()
+            if isinstance(value, Batch) and name not in param.exclude
+        }
+        pairs = []
+        for i, source in enumerate(sources):
+            attrs = {**param.attrs, **{name: values[i] for name, values in batch_values.items()}}
+            pairs.append((source.pk, self.stage(plan_model, source, attrs=attrs)))
+        return pairs
+
+    def report(self, plan_model, rows):
+        if self.progress is not None:
+            self.progress(plan_model.model, rows)
+
+    def iter_staged(self, plan_model):
+        """Yield the staged batches of ``plan_model``: Columns, or lists of ``(source pk, clone)`` pairs."""
+        if self.can_stage_columns(plan_model):
+            yield from self.iter_columns(plan_model)
+            return
+        for sources in self.iter_batches(plan_model):
+            yield self.stage_batch(plan_model, sources)
+
+    def iter_link_batches(self):
+        """Yield the ``(PlanModel, relation name, batches of (source pk, target pk))`` of the m2m relations."""
+        for plan_model in self.plan:
+            for param in plan_model.many_to_many:
+                yield plan_model, param.name, chunked(self.iter_links(plan_model, param.name), self.batch_size)
+
+    def read(self):
+        """
+        Stage every batch of rows and of m2m links of the subtree in memory, reading them in
+        one snapshot transaction of the read database, so that they are consistent with each
+        other and the writers of the source tables are never blocked by the clone.
+        """
+        with snapshot(self.read_using):
+            # The roots are frozen from the snapshot as well.
+            self.roots
+            staged = [(plan_model, list(self.iter_staged(plan_model))) for plan_model in self.plan]
+            links = [(plan_model, name, list(batches)) for plan_model, name, batches in self.iter_link_batches()]
+        return staged, links
+
+    def run(self):
+        if self.snapshot:
+            staged, links = self.read()
+        else:
+            staged = ((plan_model, self.iter_staged(plan_model)) for plan_model in self.plan)
+            links = self.iter_link_batches()
+        return self.write(staged, links)
+
+    def write(self, staged, links):
+        """
+        Write the ``(PlanModel, staged batches)`` in plan order, then the
+        ``(PlanModel, m2m relation name, batches of links)``, in one transaction. The copied
+        files are deleted when it fails.
+        """
+        try:
+            self.write_all(staged, links)
+        except Exception:
+            self.writer.delete_copies()
+            raise
+        if self.writer.batch_signals:
+            clone_finished.send(sender=self.plan.root.model, result=self.result)
+        return self.result
+
+    def write_all(self, staged, links):
+        with transaction.atomic(using=self.writer.using):
+            for plan_model, batches in staged:
+                dedupe = plan_model.policy == DEDUPE
+                if dedupe and plan_model.deferred:
+                    raise ValueError(f'Cannot deduplicate the rows of {plan_model.model._meta.label} with cyclic relations.')
+                options = {'fixed': plan_model.fixed, 'deferred': plan_model.deferred, 'dedupe': dedupe}
+                for batch in batches:
+                    if isinstance(batch, Columns):
+                        self.writer.write_columns(batch, **options)
+                    else:
+                        self.writer.write(plan_model.model, batch, **options)
+                    self.report(plan_model, len(batch))
+            self.writer.fix_deferred()
+            for plan_model, name, batches in links:
+                for pairs in batches:
+                    self.writer.link(plan_model.model, name, pairs)
@@ -0,0 +1,92 @@
+"""
+Deferred clones: the root and its one_to_one relations are cloned right away, and the
+many_to_one and many_to_many relations by a background executor, see
+CloneHandler.make_clone_deferred.
+"""
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.db import connections, transaction
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    """Return the thread pool shared by the deferred clones, created on first use."""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='clone')
+        return _executor
+
+
+class DeferredClone:
+    """
+    The cloned root ``instance``, returned before the clone of its many_to_one and many_to_many
+    relations. The relations are cloned in one transaction, started once the transaction of
+    the root commits (the background connection cannot see the root before); wait() returns
+    the root once they are cloned. When they fail, the root and its one_to_one clones are
+    deleted and wait() raises the error.
+    """
+
+    def __init__(self, handler, instance, many_to_one, many_to_many):
+        self.handler = handler
+        self.instance = instance
+        self.many_to_one = handler.sort_relations(many_to_one)
+        self.many_to_many = list(many_to_many)
+        self.cloned = 0
+        self.future = None
+        self.thread = threading.current_thread()
+
+    def __repr__(self):
+        return f'<DeferredClone {self.instance!r} {self.cloned}/{self.total}>'
+
+    @property
+    def total(self):
+        return len(self.many_to_one) + len(self.many_to_many)
+
+    @property
+    def progress(self):
+        """The ``(cloned, declared)`` numbers of relations."""
+        return self.cloned, self.total
+
+    def start(self, executor=None):
+        """Submit the clone of the relations to ``executor`` once the current transaction commits."""
+        executor = executor or get_executor()
+        transaction.on_commit(lambda: self.submit(executor), using=self.handler.write_alias)
+        return self
+
+    def submit(self, executor):
+        self.future = executor.submit(self.materialize)
+
+    def done(self):
+        return self.future is not None and self.future.done()
+
+    def wait(self, timeout=None):
+        if self.future is None:
+            raise RuntimeError('The relations are cloned once the transaction of the root commits.')
+        self.future.result(timeout)
+        return self.instance
+
+    def materialize(self):
+        handler = self.handler
+        try:
+            try:
+                with handler.delete_copies_on_error(), transaction.atomic(using=handler.write_alias):
+                    for param in self.many_to_one:
+                        handler.clone_many_to_one([param])
+                        self.cloned += 1
+                    for param in self.many_to_many:
+                        handler.clone_many_to_many([param])
+                        self.cloned += 1
+            except Exception:
+                # Do not leave a root without its relations, its one_to_one clones cascade.
+                self.instance.delete(using=handler.write_alias)
+                raise
+            if handler.signal_batch is not None:
+                handler.signal_batch, signal_batch = None, handler.signal_batch
+                signal_batch.send(handler.owner)
+        finally:
+            if threading.current_thread() is not self.thread:
+                connections.close_all()
@@ -0,0 +1,123 @@
+"""
+Duplication of the files of cloned rows, so that a clone never shares a stored file with its source.
+"""
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.files.storage import FileSystemStorage
+from django.db.models import FileField
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover, not available on Windows.
+    fcntl = None
+
+# Linux ioctl sharing the extents of a file with another one (copy on write), e.g. on btrfs and XFS.
+FICLONE = 0x40049409
+CHUNK_SIZE = 1024 * 1024
+
+
+def reflink(source, target):
+    """Make the open ``target`` file a copy on write clone of ``source``, return whether it succeeded."""
+    if fcntl is None:
+        return False
+    try:
+        fcntl.ioctl(target.fileno(), FICLONE, source.fileno())
+    except OSError:
+        return False
+    return True
+
+
+def hardlink(source, target):
+    """Hard link ``target`` to ``source``, return whether the filesystem allowed it."""
+    try:
+        os.link(source, target)
+    except FileExistsError:
+        raise
+    except OSError:
+        return False
+    return True
+
+
+def delete_copies(copies):
+    """Delete the ``(storage, name)`` copies of a clone that failed."""
+    for storage, name in copies:
+        storage.delete(name)
+
+
+class FileCopier:
+    """
+    Copy the files of the FileField (and ImageField) values of clones, ``workers`` files at a time.
+    Local files are reflinked when the filesystem allows it, hard linked with ``hardlinks``
+    (the copies then share their content until one is replaced) and copied by chunks otherwise;
+    the files of other storages are streamed by chunks.
+    """
+
+    def __init__(self, workers=4, hardlinks=False, chunk_size=CHUNK_SIZE):
+        self.workers = workers
+        self.hardlinks = hardlinks
+        self.chunk_size = chunk_size
+
+    def copy(self, storage, name):
+        """Copy the file ``name`` of ``storage`` next to it, return the name of the copy."""
+        if isinstance(storage, FileSystemStorage):
+            return self.copy_local(storage, name)
+        with storage.open(name, 'rb') as content:
+            content.DEFAULT_CHUNK_SIZE = self.chunk_size
+            return storage.save(name, content)
+
+    def copy_local(self, storage, name):
+        source = storage.path(name)
+        while True:
+            copy_name = storage.get_available_name(name)
+            target = storage.path(copy_name)
+            try:
+                if self.hardlinks and hardlink(source, target):
+                    return copy_name
+                with open(source, 'rb') as src, open(target, 'xb') as dst:
+                    if not reflink(src, dst):
+                        shutil.copyfileobj(src, dst, self.chunk_size)
+            except FileExistsError:
+                # Taken by a concurrent copy since get_available_name().
+                continue
+            if storage.file_permissions_mode is not None:
+                os.chmod(target, storage.file_permissions_mode)
+            return copy_name
+
+    def copy_all(self, files):
+        """Copy the ``(storage, name)`` files with the thread pool, return the names of the copies."""
+        if len(files) <= 1 or self.workers == 1:
+            return [self.copy(storage, name) for storage, name in files]
+        with ThreadPoolExecutor(max_workers=min(self.workers, len(files))) as executor:
+            return list(executor.map(lambda file: self.copy(*file), files))
+
+    def __call__(self, objs, exclude=(), copies=None):
+        """
+        Point the file fields of ``objs``, but the ``exclude`` ones, to copies of their files;
+        the ``(storage, name)`` of the copies are appended to the ``copies`` list, if any.
+        """
+        fields = [
+            (obj, field) for obj in objs for field in obj._meta.concrete_fields
+            if isinstance(field, FileField) and field.attname not in exclude and getattr(obj, field.attname)
+        ]
+        names = self.copy_all([(field.storage, getattr(obj, field.attname).name) for obj, field in fields])
+        for (obj, field), name in zip(fields, names):
+            setattr(obj, field.attname, name)
+            if copies is not None:
+                copies.append((field.storage, name))
+        return objs
+
+    def copy_columns(self, model, values, exclude=(), copies=None):
+        """Point the file names of the ``values`` columns ({attname: values}) to copies of the files, see __call__()."""
+        for field in model._meta.concrete_fields:
+            if not isinstance(field, FileField) or field.attname in exclude:
+                continue
+            column = values[field.attname]
+            indexes = [index for index, name in enumerate(column) if name]
+            names = self.copy_all([(field.storage, column[index]) for index in indexes])
+            for index, name in zip(indexes, names):
+                column[index] = name
+            if copies is not None:
+                copies.extend((field.storage, name) for name in names)
+        return values
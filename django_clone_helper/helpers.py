@@ -1,7 +1,31 @@
 import operator
+from contextlib import contextmanager
 from copy import copy
+from functools import partial
 
-from django_clone_helper.utils import generate_unique, LookUp
+from django.db import router
+from django.db.models.base import ModelState
+
+from django_clone_helper.bulk import (
+    DEFAULT_BATCH_SIZE, BulkCloner, ClonePlan, CloneResult, get_content_fields, get_many_to_many, get_relation,
+    insert_optimistic, save_without_signals,
+)
+from django_clone_helper.deferred import DeferredClone
+from django_clone_helper.files import FileCopier, delete_copies
+from django_clone_helper.signals import clone_batch_created, clone_finished
+from django_clone_helper.snapshots import SnapshotCache
+from django_clone_helper.unique import Probe
+from django_clone_helper.utils import select_lookups, toposort, Batch, LookUp, DEDUPE, SHARE
+
+EVENTUAL = 'eventual'
+STRICT = 'strict'
+
+
+def points_to(model, other):
+    return any(
+        field.is_relation and field.related_model._meta.concrete_model is other._meta.concrete_model
+        for field in model._meta.concrete_fields
+    )
 
 
 def get_candidate_relations_to_update(instance):
@@ -12,6 +36,23 @@ def get_candidate_relations_to_update(instance):
     return fields
 
 
+class SignalBatch:
+    """The clones saved by a make_clone in batched signal mode, announced by model once it is done."""
+
+    def __init__(self, using):
+        self.result = CloneResult(using)
+        self.pks = {}
+
+    def add(self, model, source_pk, pk):
+        self.result.add(model, source_pk, pk)
+        self.pks.setdefault(model, []).append(pk)
+
+    def send(self, sender):
+        for model, pks in self.pks.items():
+            clone_batch_created.send(sender=model, pks=pks, using=self.result.using)
+        clone_finished.send(sender=sender, result=self.result)
+
+
 class CloneMeta(type):
 
     def __get__(self, instance, owner):
@@ -24,23 +65,118 @@ class CloneHandler(metaclass=CloneMeta):
     many_to_one = []
     many_to_many = []
     unique_field_prefix = None
+    # A strategy of django_clone_helper.unique, or a {field name: strategy} dict.
+    unique_strategy = Probe()
+    # Insert first and only make the conflicting unique values unique again, see insert_optimistic.
+    optimistic = False
+    unique_retries = 3
+    # Copies the files of the clones, see django_clone_helper.files; None to share them.
+    file_copier = FileCopier()
+    # Save the clones without their pre_save, post_save and m2m_changed signals, and send
+    # clone_batch_created and clone_finished instead, see django_clone_helper.signals.
+    batch_signals = False
+    # The snapshots of the templates stamped out by stamp(), see django_clone_helper.snapshots.
+    snapshot_cache = SnapshotCache()
+    using = None
+    read_using = None
+    consistency = EVENTUAL
 
-    def __init__(self, instance, owner=None, mapping=None):
+    def __init__(self, instance, owner=None, mapping=None, using=None, read_using=None, consistency=None):
         self.instance = instance
         self.owner = owner or self.instance.__class__
         self.mapping = mapping or {}
+        self.using = using or self.using
+        self.read_using = read_using or self.read_using
+        self.consistency = consistency or self.consistency
+        # The SignalBatch shared by the handlers of a subtree cloned with batch_signals.
+        self.signal_batch = None
+        # The (storage, name) file copies of the subtree, deleted if its clone fails.
+        self.copies = None
+        if self.consistency not in (EVENTUAL, STRICT):
+            raise ValueError(f'Unknown consistency {self.consistency!r}.')
+
+    @property
+    def write_alias(self):
+        return self.using or router.db_for_write(self.owner, instance=self.instance)
+
+    @property
+    def read_alias(self):
+        return self.read_using or self.write_alias
+
+    def spawn(self, instance):
+        """Return the clone handler of a related instance, sharing this handler's routing."""
+        handler = instance.clone
+        handler.using = self.write_alias
+        handler.read_using = self.read_alias
+        handler.batch_signals = self.batch_signals
+        handler.signal_batch = self.signal_batch
+        handler.copies = self.copies
+        # The replica has already been checked against the root of the subtree.
+        handler.consistency = EVENTUAL
+        return handler
+
+    def check_replica(self):
+        """
+        With STRICT consistency, read from the write alias when the replica copy of the root
+        is missing or differs from the primary one (i.e. the replica is lagging behind).
+        """
+        if self.consistency != STRICT or self.read_alias == self.write_alias:
+            return
+        fields = [field.attname for field in self.owner._meta.concrete_fields]
+        qs = self.owner._base_manager.filter(pk=self.instance.pk).values_list(*fields)
+        if list(qs.using(self.read_alias)) != list(qs.using(self.write_alias)):
+            self.read_using = self.write_alias
 
     @classmethod
-    def _set_unique_constrain(cls, instance, prefix=None):
-        fields = [
-            field for field in instance._meta.get_fields()
+    def get_unique_strategy(cls, field):
+        if isinstance(cls.unique_strategy, dict):
+            return cls.unique_strategy.get(field.name, Probe())
+        return cls.unique_strategy
+
+    @staticmethod
+    def get_unique_fields(model):
+        return [
+            field for field in model._meta.get_fields()
             if field.concrete and field.unique and not field.primary_key
         ]
-        for field in fields:
+
+    @classmethod
+    def get_unique_values(cls, instance):
+        return {field.attname: getattr(instance, field.attname) for field in cls.get_unique_fields(instance)}
+
+    @classmethod
+    def _set_unique_constrain(cls, instance, prefix=None, using=None):
+        prefix = prefix or cls.unique_field_prefix or ''
+        for field in cls.get_unique_fields(instance):
             if hasattr(instance, field.name):
-                setattr(instance, field.name, generate_unique(instance, field))
+                strategy = cls.get_unique_strategy(field)
+                setattr(instance, field.name, strategy(instance, field, prefix=prefix, using=using))
         return instance
 
+    def get_one_to_one(self, param):
+        field = self.owner._meta.get_field(param.name)
+        qs = self.restrict(field.related_model._base_manager.using(self.read_alias), param)
+        if field.concrete:
+            return qs.filter(pk=getattr(self.instance, field.attname)).first()
+        return qs.filter(**{field.field.name: self.instance.pk}).first()
+
+    def get_many_to_one(self, param):
+        # Query the related model directly: the related manager would attach self.instance,
+        # which may live on another database, to every fetched row.
+        related_manager = getattr(self.instance, param.name)
+        qs = related_manager.model._default_manager.using(self.read_alias)
+        qs = self.restrict(qs.filter(**related_manager.core_filters), param)
+        return qs if param.limit is None else qs[:param.limit]
+
+    @staticmethod
+    def restrict(qs, param):
+        """Apply the param filters, ordering and projection to the related rows."""
+        qs = select_lookups(qs.filter(param.condition), param.attrs)
+        if param.order_by:
+            qs = qs.order_by(*param.order_by)
+        only = param.get_only(qs.model)
+        return qs.only(*only) if only else qs
+
     def update_related_from_pool(self, obj):
         result = {}
         for field in get_candidate_relations_to_update(instance=obj):
@@ -50,62 +186,238 @@ class CloneHandler(metaclass=CloneMeta):
                 result[field.name] = cloned_rel
         return result
 
-    def clone_instance(self, instance, exclude=None, attrs=None, commit=True):
+    def clone_instance(self, instance, exclude=None, attrs=None, commit=True, defaults=None):
         exclude = exclude or []
         attrs = attrs or {}
+        # Only the ``defaults`` fields (left out by Param.only) get their default value,
+        # the other deferred fields of the source are read.
+        defaults = set(defaults or [])
+        deferred = instance.get_deferred_fields()
+        if deferred - defaults:
+            instance.refresh_from_db(using=self.read_alias, fields=deferred - defaults)
+            deferred = instance.get_deferred_fields()
         cloned = copy(instance)
+        cloned._state = ModelState()
+        cloned._state.db = self.write_alias
+        cloned._state.fields_cache = dict(instance._state.fields_cache)
         cloned.pk = None
+        deferred = instance.get_deferred_fields()
+        for field in instance._meta.concrete_fields:
+            if field.attname in deferred:
+                setattr(cloned, field.attname, field.get_default())
         for k, v in attrs.items():
             if k in exclude:
                 continue
             elif isinstance(v, LookUp):
                 v = operator.attrgetter(v.name)(instance)
+            elif isinstance(v, Batch):
+                v = v.resolve([instance])[0]
             setattr(cloned, k, v() if callable(v) else v)
         if commit:
-            self._set_unique_constrain(cloned)
-            cloned.full_clean()
-            cloned.save()
+            self.save_clone(cloned, exclude=exclude, attrs=attrs)
+        return cloned
+
+    def save_clone(self, cloned, exclude=None, attrs=None):
+        """Make unique, validate, copy the files and save a clone staged by clone_instance."""
+        exclude = exclude or []
+        attrs = attrs or {}
+        originals = [self.get_unique_values(cloned)]
+        self._set_unique_constrain(cloned, using=self.write_alias)
+        cloned.full_clean(validate_unique=not self.optimistic)
+        copies = []
+        if self.file_copier is not None:
+            self.file_copier([cloned], exclude=[name for name in attrs if name not in exclude], copies=copies)
+        save = partial(self.save_all, using=self.write_alias, send_signals=not self.batch_signals)
+        try:
+            if self.optimistic:
+                insert_optimistic(self.owner, [cloned], originals, self.write_alias, save, self.unique_retries)
+            else:
+                save([cloned])
+        except Exception:
+            delete_copies(copies)
+            raise
+        if self.copies is not None:
+            self.copies.extend(copies)
+        return cloned
+
+    @contextmanager
+    def delete_copies_on_error(self):
+        """Delete the file copies of the clones saved in the block if it raises, see save_clone."""
+        if self.copies is not None:
+            # Within the clone of a subtree, that deletes them.
+            yield
+            return
+        self.copies = []
+        try:
+            yield
+        except Exception:
+            delete_copies(self.copies)
+            raise
+        finally:
+            self.copies = None
+
+    def find_or_clone(self, exclude=None, attrs=None, defaults=None):
+        """Return the existing row with the same content as the clone of the instance, or save the clone."""
+        cloned = self.clone_instance(self.instance, exclude=exclude, attrs=attrs, commit=False, defaults=defaults)
+        existing = self.owner._base_manager.using(self.write_alias).filter(**{
+            field.attname: field.value_from_object(cloned) for field in get_content_fields(self.owner)
+        }).order_by('pk').first()
+        if existing is not None:
+            if self.signal_batch is not None:
+                self.signal_batch.result.reuse(self.owner, self.instance.pk, existing.pk)
+            return existing
+        self.save_clone(cloned, exclude=exclude, attrs=attrs)
+        if self.signal_batch is not None:
+            self.signal_batch.add(self.owner, self.instance.pk, cloned.pk)
         return cloned
 
+    def clone_related(self, obj, param, attrs):
+        """Clone the related ``obj`` according to the policy of its relation ``param``."""
+        handler = self.spawn(obj)
+        defaults = param.get_defaults(obj._meta.model)
+        if param.policy == DEDUPE:
+            return handler.find_or_clone(attrs=attrs, exclude=param.exclude, defaults=defaults)
+        return handler.make_clone(attrs=attrs, exclude=param.exclude, defaults=defaults)
+
+    @staticmethod
+    def save_all(objs, using=None, send_signals=True):
+        for obj in objs:
+            if send_signals:
+                obj.save(using=using)
+            else:
+                save_without_signals(obj, using)
+
     def clone_many_to_many(self, many_to_many):
         for param in many_to_many:
             cloned = self.mapping[self.instance]
             m2m = getattr(self.instance, param.name)
-            for relation in m2m.all():
-                getattr(cloned, param.name).add(relation)
+            pks = m2m.all().using(self.read_alias).values_list('pk', flat=True)
+            if not self.batch_signals:
+                getattr(cloned, param.name).add(*pks)
+                continue
+            # Link without m2m_changed.
+            through, source_name, target_name = get_many_to_many(self.owner, param.name)
+            source, target = (through._meta.get_field(name).attname for name in (source_name, target_name))
+            through._base_manager.db_manager(self.write_alias).bulk_create(
+                [through(**{source: cloned.pk, target: pk}) for pk in pks]
+            )
 
     def clone_one_to_one(self, one_to_one):
         result = {}
         for param in one_to_one:
-            o2o = getattr(self.instance, param.name)
+            o2o = None if param.policy == SHARE else self.get_one_to_one(param)
+            if o2o is None:
+                continue
             updated_relations = self.update_related_from_pool(o2o)
             attrs = {**updated_relations, **param.attrs}
-            cloned_o2o = o2o.clone.make_clone(attrs=attrs, exclude=param.exclude)
+            cloned_o2o = self.clone_related(o2o, param, attrs)
             result.update({o2o: cloned_o2o})
         return result
 
+    def sort_relations(self, params):
+        """Order sibling relations so that each one is cloned after the relations its rows point to."""
+        related = [(param, get_relation(self.owner, param.name).related_model) for param in params]
+        related = toposort(related, lambda a, b: points_to(a[1], b[1]))
+        return [param for param, _ in related]
+
     def clone_many_to_one(self, many_to_one):
         result = {}
-        for param in many_to_one:
-            related_manager = getattr(self.instance, param.name)
-            for m2o in related_manager.all():
+        for param in self.sort_relations(many_to_one):
+            if param.policy == SHARE:
+                continue
+            rows = list(self.get_many_to_one(param))
+            # Batch attributes are computed once for all the rows of the relation.
+            batch_values = {
+                name: value.resolve(rows) for name, value in param.attrs.items()
+                if isinstance(value, Batch) and name not in (param.exclude or [])
+            }
+            for i, m2o in enumerate(rows):
                 updated_relations = self.update_related_from_pool(m2o)
                 attrs = {**updated_relations, **param.attrs}
-                cloned_m2o = m2o.clone.make_clone(attrs=attrs, exclude=param.exclude)
+                attrs.update({name: values[i] for name, values in batch_values.items()})
+                cloned_m2o = self.clone_related(m2o, param, attrs)
                 result.update({m2o: cloned_m2o})
                 self.mapping.update(result)
         return result
 
-    def make_clone(self, many_to_one=None, one_to_one=None, many_to_many=None, exclude=None, attrs=None, commit=True):
+    def make_clone(
+            self, many_to_one=None, one_to_one=None, many_to_many=None, exclude=None, attrs=None, commit=True, defaults=None
+    ):
+        many_to_one = many_to_one or self.many_to_one
+        many_to_many = many_to_many or self.many_to_many
+        one_to_one = one_to_one or self.one_to_one
+        self.check_replica()
+        root = self.batch_signals and self.signal_batch is None
+        if root:
+            self.signal_batch = SignalBatch(self.write_alias)
+        with self.delete_copies_on_error():
+            cloned_instance = self.clone_instance(
+                self.instance, attrs=attrs, exclude=exclude, commit=commit, defaults=defaults
+            )
+            if self.signal_batch is not None and commit:
+                self.signal_batch.add(self.owner, self.instance.pk, cloned_instance.pk)
+            self.mapping.update({self.instance: cloned_instance})
+            if many_to_one:
+                self.clone_many_to_one(many_to_one)
+            if one_to_one:
+                self.clone_one_to_one(one_to_one)
+            if many_to_many:
+                self.clone_many_to_many(many_to_many)
+        if root:
+            self.signal_batch, signal_batch = None, self.signal_batch
+            signal_batch.send(self.owner)
+        return cloned_instance
+
+    def make_clone_deferred(
+            self, many_to_one=None, one_to_one=None, many_to_many=None, exclude=None, attrs=None, executor=None
+    ):
+        """
+        Clone the instance and its one_to_one relations, and return a DeferredClone right away:
+        the many_to_one and many_to_many relations are cloned by ``executor`` (a
+        concurrent.futures executor, a shared thread pool by default).
+        """
         many_to_one = many_to_one or self.many_to_one
         many_to_many = many_to_many or self.many_to_many
         one_to_one = one_to_one or self.one_to_one
-        cloned_instance = self.clone_instance(self.instance, attrs=attrs, exclude=exclude, commit=commit)
+        self.check_replica()
+        if self.batch_signals:
+            self.signal_batch = SignalBatch(self.write_alias)
+        cloned_instance = self.clone_instance(self.instance, attrs=attrs, exclude=exclude)
+        if self.signal_batch is not None:
+            self.signal_batch.add(self.owner, self.instance.pk, cloned_instance.pk)
         self.mapping.update({self.instance: cloned_instance})
-        if many_to_one:
-            self.clone_many_to_one(many_to_one)
         if one_to_one:
             self.clone_one_to_one(one_to_one)
-        if many_to_many:
-            self.clone_many_to_many(many_to_many)
-        return cloned_instance
+        return DeferredClone(self, cloned_instance, many_to_one, many_to_many).start(executor)
+
+    def get_plan(self, many_to_one=None, one_to_one=None, many_to_many=None, exclude=None, attrs=None):
+        return ClonePlan(
+            self,
+            many_to_one=many_to_one,
+            one_to_one=one_to_one,
+            many_to_many=many_to_many,
+            exclude=exclude,
+            attrs=attrs,
+        )
+
+    def stamp(self, n=1, version=None, batch_size=DEFAULT_BATCH_SIZE):
+        """
+        Clone the subtree of the instance ``n`` times with bulk inserts, from its snapshot read
+        once and cached until its ``version`` changes. Return the CloneResult of each copy.
+        """
+        return self.snapshot_cache.get(self, version=version, batch_size=batch_size).stamp(n)
+
+    def get_roots(self):
+        return self.owner._default_manager.filter(pk=self.instance.pk)
+
+    def bulk_clone(self, batch_size=DEFAULT_BATCH_SIZE, validate=False, snapshot=False, **declarations):
+        """
+        Clone the same subtree as make_clone, one batch of rows per query.
+        Return a CloneResult mapping the source primary keys to the clone ones.
+        With ``snapshot``, the subtree is read from one snapshot before the write transaction.
+        """
+        self.check_replica()
+        cloner = BulkCloner(
+            self.get_plan(**declarations), self.get_roots(), batch_size=batch_size, validate=validate, snapshot=snapshot
+        )
+        return cloner.run()
@@ -0,0 +1,141 @@
+"""
+Background clone jobs: ``enqueue`` stores a CloneJob, and workers (see the ``clone_worker``
+management command) claim the pending jobs and run them with the bulk cloner.
+"""
+import multiprocessing
+import threading
+import traceback
+
+from django.contrib.contenttypes.models import ContentType
+from django.db import DatabaseError, connections
+from django.utils import timezone
+
+from django_clone_helper.bulk import DEFAULT_BATCH_SIZE, BulkCloner
+from django_clone_helper.models import CloneJob
+
+Status = CloneJob.Status
+
+
+def enqueue(instance, batch_size=DEFAULT_BATCH_SIZE):
+    """Queue the clone of ``instance`` and of the subtree declared by its handler, return the job."""
+    return CloneJob.objects.create(
+        content_type=ContentType.objects.get_for_model(instance),
+        object_id=str(instance.pk),
+        batch_size=batch_size,
+    )
+
+
+def claim():
+    """Mark the oldest pending job as running and return it, or None when there is none."""
+    while True:
+        job = CloneJob.objects.filter(status=Status.PENDING).order_by('pk').first()
+        if job is None:
+            return None
+        # Only one worker wins the update of a given job.
+        claimed = CloneJob.objects.filter(pk=job.pk, status=Status.PENDING).update(
+            status=Status.RUNNING, started_at=timezone.now()
+        )
+        if claimed:
+            job.refresh_from_db()
+            return job
+
+
+class ProgressReporter(threading.Thread):
+    """
+    Save the progress of a running job every ``interval`` seconds. The job rows are written in
+    one transaction, so the progress is saved from this thread's own database connection.
+    """
+
+    def __init__(self, job, interval=1.0):
+        super().__init__(daemon=True)
+        self.job = job
+        self.interval = interval
+        self.rows = 0
+        self.saved = 0
+        self.finished = threading.Event()
+
+    def __call__(self, model, rows):
+        self.rows += rows
+
+    def run(self):
+        try:
+            while not self.finished.wait(self.interval):
+                if self.rows != self.saved:
+                    rows = self.rows
+                    try:
+                        CloneJob.objects.filter(pk=self.job.pk).update(progress=rows)
+                    except DatabaseError:
+                        # e.g. SQLite, locked by the clone transaction until it commits.
+                        continue
+                    self.saved = rows
+        finally:
+            connections.close_all()
+
+    def stop(self):
+        self.finished.set()
+        self.join()
+
+
+def run(job):
+    """Clone the source of a claimed ``job`` and save its result, or the error."""
+    reporter = ProgressReporter(job)
+    try:
+        instance = job.source
+        if instance is None:
+            raise job.content_type.model_class().DoesNotExist(f'{job} has no source.')
+        handler = instance.clone
+        handler.check_replica()
+        cloner = BulkCloner(handler.get_plan(), handler.get_roots(), batch_size=job.batch_size, progress=reporter)
+        job.total = sum(cloner.count().values())
+        CloneJob.objects.filter(pk=job.pk).update(total=job.total)
+        reporter.start()
+        try:
+            result = cloner.run()
+        finally:
+            reporter.stop()
+    except Exception:
+        job.status, job.error = Status.FAILED, traceback.format_exc()
+    else:
+        job.status, job.progress = Status.DONE, reporter.rows
+        job.result = {
+            model._meta.label: {str(source_pk): clone_pk for source_pk, clone_pk in pks.items()}
+            for model, pks in result.mapping.items()
+        }
+    job.finished_at = timezone.now()
+    job.save(update_fields=['status', 'total', 'progress', 'result', 'error', 'finished_at'])
+    return job
+
+
+def work(once=False, poll_interval=1.0, stop=None):
+    """Run the pending jobs, until ``stop`` is set or, with ``once``, until there are none left."""
+    stop = stop or threading.Event()
+    while not stop.is_set():
+        job = claim()
+        if job is not None:
+            run(job)
+        elif once:
+            return
+        else:
+            stop.wait(poll_interval)
+
+
+def _work_in_worker(*args):
+    try:
+        work(*args)
+    finally:
+        connections.close_all()
+
+
+def start_workers(count, processes=False, once=False, poll_interval=1.0):
+    """Start ``count`` worker threads (or processes), return them and the event stopping them."""
+    if processes:
+        # The children must not share the parent's database connections.
+        connections.close_all()
+        stop = multiprocessing.Event()
+        workers = [multiprocessing.Process(target=_work_in_worker, args=(once, poll_interval, stop)) for _ in range(count)]
+    else:
+        stop = threading.Event()
+        workers = [threading.Thread(target=_work_in_worker, args=(once, poll_interval, stop)) for _ in range(count)]
+    for worker in workers:
+        worker.start()
+    return workers, stop
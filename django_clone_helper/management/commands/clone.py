@@ -0,0 +1,127 @@
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from django_clone_helper.bulk import DEFAULT_BATCH_SIZE, BulkCloner
+from django_clone_helper.utils import chunked
+
+
+class Progress:
+    """Thread safe progress of a clone job, reported as rows per second and time left."""
+
+    def __init__(self, total, write):
+        self.total = total
+        self.write = write
+        self.done = Counter()
+        self.started = time.monotonic()
+        self.lock = threading.Lock()
+
+    def __call__(self, model, rows):
+        with self.lock:
+            self.done[model._meta.label] += rows
+            done = sum(self.done.values())
+            rate = done / max(time.monotonic() - self.started, 1e-6)
+            eta = max(self.total - done, 0) / rate
+            self.write(f'{model._meta.label}: {done}/{self.total} rows, {rate:.0f} rows/s, ETA {eta:.0f}s')
+
+
+class Command(BaseCommand):
+    help = 'Clone the declared subtree of every row of a model matching the given filters.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('model', help='Label of the model to clone, e.g. app_label.ModelName.')
+        parser.add_argument(
+            '--filter', action='append', default=[], dest='filters', metavar='LOOKUP=VALUE',
+            help='Filter the rows to clone, e.g. --filter name__startswith=Les. Can be repeated.',
+        )
+        parser.add_argument(
+            '--batch-size', type=int, default=DEFAULT_BATCH_SIZE,
+            help='Rows read and inserted per query, and root rows cloned per transaction.',
+        )
+        parser.add_argument(
+            '--workers', type=int, default=1,
+            help='Number of threads cloning a share of the batches of root rows.',
+        )
+        parser.add_argument(
+            '--validate', choices=['none', 'full'], default='none',
+            help='Run full_clean() on every clone before inserting it.',
+        )
+        parser.add_argument(
+            '--snapshot', action='store_true',
+            help='Read the subtree of each batch of root rows from one snapshot before writing it, in memory.',
+        )
+        parser.add_argument('--dry-run', action='store_true', help='Only count the rows that would be cloned.')
+
+    def handle(self, *args, **options):
+        try:
+            model = apps.get_model(options['model'])
+        except (LookupError, ValueError) as e:
+            raise CommandError(e)
+        if options['batch_size'] < 1 or options['workers'] < 1:
+            raise CommandError('--batch-size and --workers must be positive.')
+        lookups = {}
+        for item in options['filters']:
+            lookup, sep, value = item.partition('=')
+            if not sep:
+                raise CommandError(f'Invalid filter {item!r}, expected LOOKUP=VALUE.')
+            lookups[lookup] = value
+
+        handler = model.clone
+        handler.check_replica()
+        plan = handler.get_plan()
+        roots = model._default_manager.using(handler.read_alias).filter(**lookups).order_by('pk').values_list('pk', flat=True)
+        # Each batch of roots is cloned in its own transaction, keeping the statements and
+        # the transactions bounded whatever the number of roots.
+        batches = list(chunked(roots.iterator(chunk_size=options['batch_size']), options['batch_size']))
+        totals = Counter()
+        for pks in batches:
+            counts = BulkCloner(plan, model._default_manager.filter(pk__in=pks)).count()
+            totals.update({model._meta.label: count for model, count in counts.items()})
+        if options['dry_run']:
+            self.write_summary('Would clone', totals)
+            return
+
+        progress = Progress(sum(totals.values()), self.stdout.write) if options['verbosity'] else None
+        cloner_options = {
+            'batch_size': options['batch_size'],
+            'validate': options['validate'] == 'full',
+            'progress': progress,
+            'snapshot': options['snapshot'],
+        }
+        started = time.monotonic()
+        workers = min(options['workers'], len(batches)) or 1
+        if workers > 1 and connections[handler.write_alias].vendor == 'sqlite':
+            self.stderr.write('SQLite allows a single writer at a time, running with one worker.')
+            workers = 1
+        shares = [batches[i::workers] for i in range(workers)]
+        if workers == 1:
+            results = self.clone(plan, model, shares[0], cloner_options)
+        else:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = [executor.submit(self.clone_in_thread, plan, model, share, cloner_options) for share in shares]
+                results = [result for future in futures for result in future.result()]
+        counts = Counter()
+        for result in results:
+            counts.update(result.counts)
+        self.write_summary(f'Cloned in {time.monotonic() - started:.1f}s', counts)
+
+    @staticmethod
+    def clone(plan, model, batches, options):
+        """Clone the ``batches`` of root primary keys one after the other, return their CloneResult."""
+        return [BulkCloner(plan, model._default_manager.filter(pk__in=pks), **options).run() for pks in batches]
+
+    def clone_in_thread(self, plan, model, batches, options):
+        try:
+            return self.clone(plan, model, batches, options)
+        finally:
+            connections.close_all()
+
+    def write_summary(self, title, counts):
+        self.stdout.write(f'{title} {sum(counts.values())} rows:')
+        for label, count in counts.items():
+            self.stdout.write(f'  {label}: {count}')
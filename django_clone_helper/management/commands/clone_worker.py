@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from django_clone_helper.jobs import start_workers, work
+
+
+class Command(BaseCommand):
+    help = 'Run the queued clone jobs with a pool of worker threads or processes.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=1, help='Number of jobs run at the same time.')
+        parser.add_argument('--processes', action='store_true', help='Run the workers in processes instead of threads.')
+        parser.add_argument('--once', action='store_true', help='Exit once there are no pending jobs left.')
+        parser.add_argument('--poll-interval', type=float, default=1.0, help='Seconds to wait when the queue is empty.')
+
+    def handle(self, *args, **options):
+        if options['workers'] < 1:
+            raise CommandError('--workers must be positive.')
+        if options['workers'] == 1 and not options['processes']:
+            try:
+                work(once=options['once'], poll_interval=options['poll_interval'])
+            except KeyboardInterrupt:
+                pass
+            return
+        workers, stop = start_workers(
+            options['workers'], processes=options['processes'], once=options['once'], poll_interval=options['poll_interval']
+        )
+        try:
+            for worker in workers:
+                worker.join()
+        except KeyboardInterrupt:
+            # Let the running jobs finish.
+            stop.set()
+            for worker in workers:
+                worker.join()
@@ -0,0 +1,39 @@
+# Generated by Django 3.1.4 on 2026-10-19 10:55
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_clone_helper', '0008_taggeditem'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='F',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='G',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('f', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='django_clone_helper.f')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='f',
+            name='featured',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='django_clone_helper.g'),
+        ),
+        migrations.CreateModel(
+            name='E',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('parent', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='children', to='django_clone_helper.e')),
+            ],
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 3.1.4 on 2026-10-19 11:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_clone_helper', '0009_e_f_g'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UniqueCounter',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('label', models.CharField(max_length=255)),
+                ('field', models.CharField(max_length=255)),
+                ('value', models.PositiveBigIntegerField(default=0)),
+            ],
+            options={
+                'unique_together': {('label', 'field')},
+            },
+        ),
+    ]
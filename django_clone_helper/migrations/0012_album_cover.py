@@ -0,0 +1,18 @@
+# Generated by Django 3.1.4 on 2026-10-19 11:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_clone_helper', '0011_clonejob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='album',
+            name='cover',
+            field=models.FileField(blank=True, upload_to='covers'),
+        ),
+    ]
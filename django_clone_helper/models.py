@@ -2,11 +2,49 @@ from uuid import uuid4
 
 from django.contrib.contenttypes.fields import GenericForeignKey, GenericRelation
 from django.contrib.contenttypes.models import ContentType
+from django.core.serializers.json import DjangoJSONEncoder
 from django.db import models
 
 from django_clone_helper.helpers import CloneHandler
 
 
+class UniqueCounter(models.Model):
+    """Last value handed out by the Counter unique strategy for a field."""
+    label = models.CharField(max_length=255)
+    field = models.CharField(max_length=255)
+    value = models.PositiveBigIntegerField(default=0)
+
+    class Meta:
+        unique_together = [('label', 'field')]
+
+
+class CloneJob(models.Model):
+    """A queued bulk clone of ``source`` and its declared subtree, see django_clone_helper.jobs."""
+
+    class Status(models.TextChoices):
+        PENDING = 'pending'
+        RUNNING = 'running'
+        DONE = 'done'
+        FAILED = 'failed'
+
+    content_type = models.ForeignKey(ContentType, on_delete=models.CASCADE)
+    object_id = models.CharField(max_length=255)
+    source = GenericForeignKey('content_type', 'object_id')
+    batch_size = models.PositiveIntegerField()
+    status = models.CharField(max_length=16, choices=Status.choices, default=Status.PENDING, db_index=True)
+    total = models.PositiveIntegerField(default=0)
+    progress = models.PositiveIntegerField(default=0)
+    # Source to clone primary keys per model label, set once the job is done.
+    result = models.JSONField(null=True, blank=True, encoder=DjangoJSONEncoder)
+    error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f'Clone of {self.content_type.model} {self.object_id} ({self.status})'
+
+
 class TaggedItem(models.Model):
     tag = models.SlugField()
     content_type = models.ForeignKey(ContentType, on_delete=models.CASCADE)
@@ -68,6 +106,7 @@ class Passport(models.Model):
 class Album(models.Model):
     title = models.CharField(max_length=100)
     artist = models.ForeignKey(Artist, on_delete=models.CASCADE)
+    cover = models.FileField(upload_to='covers', blank=True)
 
     class clone(CloneHandler):
         pass
@@ -160,3 +199,24 @@ class D(models.Model):
 
     class clone(CloneHandler):
         pass
+
+
+class E(models.Model):
+    parent = models.ForeignKey('self', null=True, blank=True, related_name='children', on_delete=models.CASCADE)
+
+    class clone(CloneHandler):
+        pass
+
+
+class F(models.Model):
+    featured = models.ForeignKey('G', null=True, blank=True, related_name='+', on_delete=models.SET_NULL)
+
+    class clone(CloneHandler):
+        pass
+
+
+class G(models.Model):
+    f = models.ForeignKey(F, on_delete=models.CASCADE)
+
+    class clone(CloneHandler):
+        pass
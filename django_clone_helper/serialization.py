@@ -0,0 +1,135 @@
+"""
+Line oriented (JSONL) export of a declared clone subtree, and its replay.
+
+The file starts with a header line, followed by one section per model in dependency order
+(``level`` being its depth in the dependency graph), each made of a section line and one
+line per row, and ends with the m2m link sections::
+
+    {"format": "django-clone-helper", "version": 1, "root": "app.artist"}
+    {"section": "app.artist", "level": 0, "fixed": ["name"], "deferred": []}
+    {"pk": 1, "fields": {"id": null, "name": "Les"}}
+    {"links": "app.compilation", "name": "songs"}
+    {"pk": 1, "target": 4}
+
+Rows are exported with the handler ``attrs`` already applied, keyed by their source
+primary key: the importer remaps the relations and inserts them through the bulk writer.
+The foreign keys to ContentType are exported as their natural key, ``[app_label, model]``,
+their ids differing between databases.
+"""
+import json
+
+from django.apps import apps
+from django.contrib.contenttypes.models import ContentType
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import router, transaction
+from django.utils.encoding import is_protected_type
+
+from django_clone_helper.bulk import DEFAULT_BATCH_SIZE, BulkCloner, BulkWriter, get_many_to_many
+
+FORMAT = 'django-clone-helper'
+VERSION = 2
+# Version 1 exported the ContentType foreign keys as ids.
+SUPPORTED_VERSIONS = (1, VERSION)
+
+
+def dumps(record):
+    return json.dumps(record, cls=DjangoJSONEncoder, separators=(',', ':'))
+
+
+def is_content_type(field):
+    return field.is_relation and field.related_model is ContentType
+
+
+def serialize_value(field, obj, using=None):
+    value = field.value_from_object(obj)
+    if is_content_type(field) and value is not None:
+        return list(ContentType.objects.db_manager(using).get_for_id(value).natural_key())
+    return value if is_protected_type(value) else field.value_to_string(obj)
+
+
+def export_subtree(handler, batch_size=DEFAULT_BATCH_SIZE, **declarations):
+    """Yield the lines of the subtree declared by ``handler`` (see make_clone for the declarations)."""
+    handler.check_replica()
+    plan = handler.get_plan(**declarations)
+    cloner = BulkCloner(plan, handler.get_roots(), batch_size=batch_size)
+    yield dumps({'format': FORMAT, 'version': VERSION, 'root': handler.owner._meta.label_lower})
+    for plan_model in plan:
+        meta = plan_model.model._meta
+        yield dumps({
+            'section': meta.label_lower,
+            'level': plan_model.level,
+            'fixed': sorted(plan_model.fixed),
+            'deferred': [field.name for field in plan_model.deferred],
+        })
+        for sources in cloner.iter_batches(plan_model):
+            for source, (_, clone) in zip(sources, cloner.stage_batch(plan_model, sources)):
+                values = {
+                    field.attname: serialize_value(field, clone, cloner.read_using) for field in meta.concrete_fields
+                }
+                yield dumps({'pk': serialize_value(meta.pk, source), 'fields': values})
+    for plan_model in plan:
+        for param in plan_model.many_to_many:
+            yield dumps({'links': plan_model.model._meta.label_lower, 'name': param.name})
+            for source_pk, target_pk in cloner.iter_links(plan_model, param.name):
+                yield dumps({'pk': source_pk, 'target': target_pk})
+
+
+def deserialize_value(field, value, using=None):
+    if is_content_type(field) and isinstance(value, list):
+        return ContentType.objects.db_manager(using).get_by_natural_key(*value).pk
+    return field.to_python(value)
+
+
+def deserialize(model, record, using=None):
+    meta = model._meta
+    fields = {
+        field.attname: deserialize_value(field, record['fields'][field.attname], using)
+        for field in meta.concrete_fields if field.attname in record['fields']
+    }
+    return meta.pk.to_python(record['pk']), model(**fields)
+
+
+def import_subtree(lines, using=None, batch_size=DEFAULT_BATCH_SIZE, validate=False):
+    """Replay the exported ``lines`` (any iterable, e.g. an open file) and return the CloneResult."""
+    lines = iter(lines)
+    header = json.loads(next(lines))
+    if header.get('format') != FORMAT or header.get('version') not in SUPPORTED_VERSIONS:
+        raise ValueError(f'Unsupported clone export header {header!r}.')
+    using = using or router.db_for_write(apps.get_model(header['root']))
+    # The files are not part of the export: the imported rows keep their file names.
+    writer = BulkWriter(using, batch_size=batch_size, validate=validate, copy_files=False)
+    with transaction.atomic(using=using):
+        for section, records in _iter_sections(lines, batch_size):
+            if 'section' in section:
+                model = apps.get_model(section['section'])
+                pairs = [deserialize(model, record, using) for record in records]
+                deferred = [model._meta.get_field(name) for name in section['deferred']]
+                writer.write(model, pairs, fixed=set(section['fixed']), deferred=deferred)
+            else:
+                model = apps.get_model(section['links'])
+                through, _, target_name = get_many_to_many(model, section['name'])
+                source, target = model._meta.pk, through._meta.get_field(target_name)
+                pairs = [(source.to_python(record['pk']), target.to_python(record['target'])) for record in records]
+                writer.link(model, section['name'], pairs)
+        writer.fix_deferred()
+    return writer.result
+
+
+def _iter_sections(lines, batch_size):
+    """Yield ``(section, records)`` batches of at most ``batch_size`` records."""
+    section, records = None, []
+    for line in lines:
+        if not line.strip():
+            continue
+        record = json.loads(line)
+        if 'section' in record or 'links' in record:
+            if records:
+                yield section, records
+            section, records = record, []
+            continue
+        records.append(record)
+        if len(records) >= batch_size:
+            yield section, records
+            records = []
+    if records:
+        yield section, records
@@ -0,0 +1,10 @@
+"""
+Signals of the batched signal mode (CloneHandler.batch_signals), in which the clones are
+saved without their per row ``pre_save``, ``post_save`` and ``m2m_changed`` signals.
+"""
+from django.dispatch import Signal
+
+# Sent by the model of a batch of inserted clones, with their primary keys ``pks`` and ``using``.
+clone_batch_created = Signal()
+# Sent by the model of the root once a clone is written, with its CloneResult ``result``.
+clone_finished = Signal()
@@ -0,0 +1,144 @@
+"""
+Template snapshots: the declared subtree of a template instance read once into memory, and
+stamped out any number of times through the bulk write path without reading the source again.
+"""
+import sys
+import threading
+import time
+from collections import OrderedDict
+from copy import copy
+
+from django.db import transaction
+
+from django_clone_helper.bulk import DEFAULT_BATCH_SIZE, BulkCloner, snapshot
+
+DEFAULT_MAX_SIZE = 64 * 1024 * 1024
+
+
+def get_size(values):
+    """Estimate the memory used by a list of values, in bytes."""
+    return sys.getsizeof(values) + sum(sys.getsizeof(value) for value in values)
+
+
+class TemplateSnapshot:
+    """
+    The rows of the subtree declared by ``handler`` and their m2m links, read from one
+    snapshot of the read database. The rows that can be staged as Columns are kept as
+    their source columns, the other ones as source instances; the attrs are applied again
+    for every copy, so that callables and unique values differ between copies.
+    """
+
+    def __init__(self, handler, version=None, batch_size=DEFAULT_BATCH_SIZE):
+        self.version = version
+        self.loaded_at = time.monotonic()
+        handler.check_replica()
+        self.cloner = BulkCloner(handler.get_plan(), handler.get_roots(), batch_size=batch_size)
+        self.rows = []
+        with snapshot(self.cloner.read_using):
+            for plan_model in self.cloner.plan:
+                if self.cloner.can_stage_columns(plan_model):
+                    batches = list(self.cloner.iter_values(plan_model))
+                else:
+                    batches = list(self.cloner.iter_batches(plan_model))
+                self.rows.append((plan_model, batches))
+            self.links = [(plan_model, name, list(batches)) for plan_model, name, batches in self.cloner.iter_link_batches()]
+        self.size = self.get_size()
+
+    def __repr__(self):
+        return f'<TemplateSnapshot {self.cloner.plan.root.model._meta.label} {self.size} bytes>'
+
+    def get_size(self):
+        size = 0
+        for _, batches in self.rows:
+            for batch in batches:
+                if isinstance(batch, tuple):
+                    size += sum(get_size(column) for columns in batch for column in columns.values())
+                else:
+                    size += sum(get_size(list(obj.__dict__.values())) for obj in batch)
+        for _, _, batches in self.links:
+            size += sum(get_size(pairs) for pairs in batches)
+        return size
+
+    def stage(self, plan_model, batch):
+        if isinstance(batch, tuple):
+            values, lookups = batch
+            # Staging fills the column lists in place.
+            return self.cloner.stage_columns(plan_model, {name: list(column) for name, column in values.items()}, lookups)
+        return self.cloner.stage_batch(plan_model, batch)
+
+    def iter_staged(self):
+        for plan_model, batches in self.rows:
+            yield plan_model, (self.stage(plan_model, batch) for batch in batches)
+
+    def stamp(self, n=1):
+        """Write ``n`` clones of the template subtree in one transaction, return their CloneResult."""
+        results, writers = [], []
+        try:
+            with transaction.atomic(using=self.cloner.writer.using):
+                for _ in range(n):
+                    # The plan and the staging are shared, each copy has its own writer.
+                    cloner = copy(self.cloner)
+                    cloner.writer = cloner.new_writer()
+                    writers.append(cloner.writer)
+                    results.append(cloner.write(self.iter_staged(), self.links))
+        except Exception:
+            # The copies written before the failing one are rolled back as well.
+            for writer in writers:
+                writer.delete_copies()
+            raise
+        return results
+
+
+class SnapshotCache:
+    """
+    TemplateSnapshot of the templates, per instance and read database. A snapshot is read
+    again when it was loaded with another ``version`` (e.g. a version number or the last
+    modification time of the template) or more than ``max_age`` seconds ago; the least
+    recently used ones are evicted once they take more than ``max_size`` bytes.
+    """
+
+    def __init__(self, max_size=DEFAULT_MAX_SIZE, max_age=None):
+        self.max_size = max_size
+        self.max_age = max_age
+        self.snapshots = OrderedDict()
+        self.lock = threading.Lock()
+
+    @property
+    def size(self):
+        return sum(template.size for template in self.snapshots.values())
+
+    @staticmethod
+    def get_key(handler):
+        label = handler.owner._meta.concrete_model._meta.label
+        return label, handler.instance.pk, handler.read_alias, handler.write_alias
+
+    def is_fresh(self, template, version):
+        if template.version != version:
+            return False
+        return self.max_age is None or time.monotonic() - template.loaded_at <= self.max_age
+
+    def get(self, handler, version=None, batch_size=DEFAULT_BATCH_SIZE):
+        """Return the snapshot of the template ``handler.instance``, read if missing or stale."""
+        key = self.get_key(handler)
+        with self.lock:
+            template = self.snapshots.get(key)
+            if template is not None and self.is_fresh(template, version):
+                self.snapshots.move_to_end(key)
+                return template
+        template = TemplateSnapshot(handler, version=version, batch_size=batch_size)
+        with self.lock:
+            self.snapshots[key] = template
+            self.snapshots.move_to_end(key)
+            while len(self.snapshots) > 1 and self.size > self.max_size:
+                self.snapshots.popitem(last=False)
+        return template
+
+    def invalidate(self, instance=None):
+        """Forget the snapshots of ``instance``, or all of them."""
+        with self.lock:
+            if instance is None:
+                self.snapshots.clear()
+                return
+            label = instance._meta.concrete_model._meta.label
+            for key in [key for key in self.snapshots if key[:2] == (label, instance.pk)]:
+                del self.snapshots[key]
@@ -1,8 +1,31 @@
+import json
+import os
+import re
+import collections
+import sqlite3
+from concurrent.futures import Executor, Future
+from contextlib import contextmanager
+from copy import copy
+from io import StringIO
+from unittest.mock import Mock
 from uuid import uuid4
 
 import pytest
-
+from django.apps import apps
+from django.core.exceptions import ImproperlyConfigured, ValidationError
+from django.core.files.base import ContentFile
+from django.core.management import CommandError, call_command
+from django.db import IntegrityError, connection, transaction
+from django.db.models import Q
+from django.db.models.base import ModelState
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_init, pre_save
+from django.urls import reverse
+from django.test.utils import CaptureQueriesContext
+
+from .bulk import BulkCloner, BulkWriter, InsertStatement, enable_wal, undo_clone
+from .files import FileCopier
 from .helpers import CloneHandler
+from .jobs import claim, enqueue, work
 
 from django_clone_helper.models import (
     Artist,
@@ -15,10 +38,17 @@ from django_clone_helper.models import (
     Group,
     Membership,
     BassGuitar,
-    A, B, C, D,
-    TaggedItem
+    A, B, C, D, E, F, G,
+    CloneJob,
+    TaggedItem,
+    UniqueCounter,
 )
-from .utils import Param, LookUp
+from .serialization import export_subtree, import_subtree
+from .signals import clone_batch_created, clone_finished
+from .snapshots import SnapshotCache
+from .unique import Counter, RandomSuffix
+from .verification import verify
+from .utils import DEDUPE, SHARE, Batch, Param, LookUp, get_related_path
 
 
 @pytest.fixture
@@ -86,15 +116,49 @@ def check_model_count(model, expected):
     assert model.objects.count() == expected
 
 
+QUERY_TABLE = re.compile(r'(?:FROM|INTO|UPDATE)\s+"(\w+)"')
+
+
+def count_queries_per_model(queries):
+    """Count the ``queries`` per model label of the first table they read or write."""
+    tables = {model._meta.db_table: model._meta.label for model in apps.get_models(include_auto_created=True)}
+    counts = collections.Counter()
+    for query in queries:
+        match = QUERY_TABLE.search(query['sql'])
+        counts[tables.get(match.group(1), match.group(1)) if match else 'other'] += 1
+    return counts
+
+
+@pytest.fixture
+def query_budget():
+    """
+    Fail when the queries run in the block exceed ``formula``, an expression of the given
+    variables (e.g. ``query_budget('3 * depth + 2', depth=4)``), with a per model breakdown.
+    """
+    @contextmanager
+    def _query_budget(formula, **variables):
+        with CaptureQueriesContext(connection) as ctx:
+            yield ctx
+        budget = eval(formula, {'__builtins__': {}}, variables)
+        if len(ctx) > budget:
+            breakdown = '\n'.join(
+                f'  {label}: {count}' for label, count in count_queries_per_model(ctx.captured_queries).most_common()
+            )
+            pytest.fail(f'{len(ctx)} queries, over the budget {formula} = {budget} with {variables}:\n{breakdown}')
+    return _query_budget
+
+
 @pytest.fixture
 def patch_clone(monkeypatch):
     def _patch_factory(model, **kwargs):
         class clone_patch(CloneHandler):
-            exclude = kwargs.get('exclude', [])
-            attrs = kwargs.get('attrs', {})
-            one_to_one = kwargs.get('one_to_one', [])
-            many_to_one = kwargs.get('many_to_one', [])
-            many_to_many = kwargs.get('many_to_many', [])
+            exclude = kwargs.pop('exclude', [])
+            attrs = kwargs.pop('attrs', {})
+            one_to_one = kwargs.pop('one_to_one', [])
+            many_to_one = kwargs.pop('many_to_one', [])
+            many_to_many = kwargs.pop('many_to_many', [])
+        for name, value in kwargs.items():
+            setattr(clone_patch, name, value)
         monkeypatch.setattr(model, 'clone', clone_patch)
     return _patch_factory
 
@@ -409,3 +473,1072 @@ class TestCloneHandler:
         cloned_album = cloned_artist.album_set.get()
         cloned_song = cloned_album.song_set.get()
         assert cloned_song.album == cloned_album
+
+
+@pytest.fixture
+def replicate():
+    def _replicate(obj, **changes):
+        replica = copy(obj)
+        replica._state = ModelState()
+        for k, v in changes.items():
+            setattr(replica, k, v)
+        replica.save(using='replica', force_insert=True)
+        return replica
+    return _replicate
+
+
+@pytest.mark.django_db(databases=['default', 'replica'])
+class TestReadReplica:
+
+    def test_reads_from_replica_and_writes_to_primary(self, album, replicate, patch_clone):
+        artist = album.artist
+        replicate(artist)
+        replicate(album, title='Replica Title')
+        patch_clone(Artist, many_to_one=[Param('album_set')], read_using='replica', using='default')
+
+        cloned_artist = artist.clone.make_clone()
+
+        check_model_count(Artist, 2)
+        check_model_count(Album, 2)
+        assert Album.objects.using('replica').count() == 1
+        assert cloned_artist.album_set.get().title == 'Replica Title'
+
+    def test_strict_consistency_falls_back_to_primary(self, album, replicate, patch_clone):
+        artist = album.artist
+        replicate(artist, name='Stale name')
+        replicate(album, title='Stale title')
+        patch_clone(Artist, many_to_one=[Param('album_set')], read_using='replica', consistency='strict')
+
+        handler = artist.clone
+        cloned_artist = handler.make_clone()
+
+        assert handler.read_alias == 'default'
+        assert cloned_artist.album_set.get().title == album.title
+
+    def test_unique_check_uses_write_alias(self, instrument, replicate):
+        replicate(instrument)
+        Instrument.objects.create(name='bass', serial_number=f'{instrument.serial_number}1')
+
+        handler = CloneHandler(instrument, read_using='replica')
+        cloned = handler.make_clone(attrs={'id': uuid4()})
+        assert cloned.serial_number == f'{instrument.serial_number}2'
+        assert Instrument.objects.using('replica').count() == 1
+
+    def test_unknown_consistency(self, artist):
+        with pytest.raises(ValueError):
+            CloneHandler(artist, consistency='sometimes')
+
+
+@pytest.mark.django_db
+class TestBulkClone:
+
+    def test_bulk_clone_update_relations(self, patch_clone, album, song):
+        patch_clone(Artist, many_to_one=[Param('album_set'), Param('song_set', attrs={'title': 'Bulk'})])
+        artist = album.artist
+
+        result = artist.clone.bulk_clone()
+        check_model_count(Artist, 2)
+        check_model_count(Album, 2)
+        check_model_count(Song, 2)
+
+        cloned_artist = result.get_clone(artist)
+        cloned_album = cloned_artist.album_set.get()
+        cloned_song = cloned_artist.song_set.get()
+        assert cloned_album == result.get_clone(album)
+        assert cloned_song.album == cloned_album
+        assert cloned_song.title == 'Bulk'
+        assert result.counts == {'django_clone_helper.Artist': 1, 'django_clone_helper.Album': 1, 'django_clone_helper.Song': 1}
+
+    def test_bulk_clone_chained_models(self, patch_clone):
+        a = A.objects.create()
+        for _ in range(3):
+            b = B.objects.create(a=a)
+            D.objects.create(c=C.objects.create(b=b))
+        patch_clone(A, many_to_one=[Param('b_set')])
+        patch_clone(B, many_to_one=[Param('c_set')])
+        patch_clone(C, many_to_one=[Param('d_set')])
+
+        result = a.clone.bulk_clone(batch_size=2)
+        cloned_a = result.get_clone(a)
+        assert D.objects.filter(c__b__a=cloned_a).count() == 3
+        check_model_count(D, 6)
+
+    def test_forward_one_to_one(self, patch_clone, passport):
+        patch_clone(Passport, one_to_one=[Param('owner')])
+        with pytest.raises(ValueError, match='forward one_to_one'):
+            passport.clone.get_plan()
+
+    def test_bulk_clone_o2o_generic_and_m2m(self, patch_clone, passport, compilation):
+        artist = passport.owner
+        artist.tags.add(TaggedItem(tag='foo'), TaggedItem(tag='bar'), bulk=False)
+        patch_clone(Artist, one_to_one=[Param('passport')], many_to_one=[Param('tags')])
+        patch_clone(Compilation, many_to_many=[Param('songs')])
+
+        cloned_artist = artist.clone.bulk_clone().get_clone(artist)
+        assert cloned_artist.passport != artist.passport
+        assert sorted(cloned_artist.tags.values_list('tag', flat=True)) == ['bar', 'foo']
+
+        cloned_compilation = compilation.clone.bulk_clone().get_clone(compilation)
+        assert set(cloned_compilation.songs.all()) == set(compilation.songs.all())
+
+    def test_bulk_clone_inheritance(self, bass_guitar):
+        result = bass_guitar.clone.bulk_clone(attrs={'name': 'Fender'})
+        cloned_bass = result.get_clone(bass_guitar)
+        check_model_count(BassGuitar, 2)
+        assert cloned_bass.name == 'Fender'
+        assert cloned_bass.serial_number == f'{bass_guitar.serial_number}1'
+
+
+@pytest.mark.django_db
+class TestExportImport:
+
+    def test_export_import_roundtrip(self, patch_clone, album, song, compilation):
+        patch_clone(Artist, many_to_one=[Param('album_set', attrs={'title': 'Exported'}), Param('song_set')])
+        artist = album.artist
+        lines = list(export_subtree(artist.clone))
+        assert json.loads(lines[0])['root'] == 'django_clone_helper.artist'
+        sections = [json.loads(line) for line in lines if '"section"' in line]
+        assert [(s['section'], s['level']) for s in sections] == [
+            ('django_clone_helper.artist', 0), ('django_clone_helper.album', 1), ('django_clone_helper.song', 2)
+        ]
+        check_model_count(Artist, 1)
+
+        result = import_subtree(iter(lines), batch_size=2)
+        check_model_count(Artist, 2)
+        check_model_count(Album, 2)
+        check_model_count(Song, 6)
+        cloned_album = result.get_clone(album)
+        assert cloned_album.title == 'Exported'
+        assert cloned_album.artist == result.get_clone(artist)
+        assert cloned_album.song_set.count() == 3
+
+    def test_export_import_m2m(self, patch_clone, compilation):
+        patch_clone(Compilation, many_to_many=[Param('songs')])
+        result = import_subtree(export_subtree(compilation.clone))
+        assert set(result.get_clone(compilation).songs.all()) == set(compilation.songs.all())
+
+    def test_content_types_natural_keys(self, patch_clone, artist):
+        artist.tags.add(TaggedItem(tag='rock'), bulk=False)
+        patch_clone(Artist, many_to_one=[Param('tags')])
+        lines = list(export_subtree(artist.clone))
+        tag_line = json.loads(lines[-1])
+        assert tag_line['fields']['content_type_id'] == ['django_clone_helper', 'artist']
+
+        result = import_subtree(lines)
+        cloned_tag = TaggedItem.objects.get(pk=result.get(TaggedItem, artist.tags.get().pk))
+        assert cloned_tag.content_object == result.get_clone(artist)
+
+    def test_import_rejects_unknown_format(self, db):
+        with pytest.raises(ValueError):
+            import_subtree(['{"format": "other"}'])
+
+
+@pytest.mark.django_db
+class TestBatchAttrs:
+
+    def test_batch_callable_called_once_per_batch(self, patch_clone, album):
+        artist = album.artist
+        for title in ('Sailing the Seas of Cheese', 'Pork Soda'):
+            Album.objects.create(title=title, artist=artist)
+        calls = []
+
+        def titles(albums):
+            calls.append(len(albums))
+            return [f'{album.title} (remastered)' for album in albums]
+
+        patch_clone(Artist, many_to_one=[Param('album_set', attrs={'title': Batch(titles)})])
+        cloned_artist = artist.clone.bulk_clone(batch_size=2).get_clone(artist)
+        assert calls == [2, 1]
+        assert sorted(cloned_artist.album_set.values_list('title', flat=True)) == [
+            'Frizzle Fry (remastered)', 'Pork Soda (remastered)', 'Sailing the Seas of Cheese (remastered)'
+        ]
+
+    def test_batch_callable_with_fields(self, patch_clone, album):
+        artist = album.artist
+        lookup_table = {'Frizzle Fry': 'FF'}
+        batch = Batch(lambda rows: [lookup_table[row['title']] for row in rows], fields=['title'])
+        patch_clone(Artist, many_to_one=[Param('album_set', attrs={'title': batch})])
+
+        cloned_artist = artist.clone.make_clone()
+        assert cloned_artist.album_set.get().title == 'FF'
+
+    def test_batch_callable_once_per_relation(self, patch_clone, album):
+        Album.objects.create(title='Pork Soda', artist=album.artist)
+        calls = []
+
+        def titles(albums):
+            calls.append(len(albums))
+            return [album.title.upper() for album in albums]
+
+        patch_clone(Artist, many_to_one=[Param('album_set', attrs={'title': Batch(titles)})])
+        cloned_artist = album.artist.clone.make_clone()
+        assert calls == [2]
+        assert sorted(cloned_artist.album_set.values_list('title', flat=True)) == ['FRIZZLE FRY', 'PORK SODA']
+
+    def test_batch_callable_wrong_length(self, artist):
+        with pytest.raises(ValueError):
+            artist.clone.bulk_clone(attrs={'name': Batch(lambda artists: [])})
+
+
+@pytest.mark.django_db
+class TestLookUpJoin:
+
+    def test_get_related_path(self):
+        assert get_related_path(SongPart, 'song.album.artist.name') == 'song__album__artist'
+        assert get_related_path(Album, 'artist.set_album_title') == 'artist'
+        assert get_related_path(Album, 'title') is None
+        assert get_related_path(Artist, 'passport.owner') == 'passport'
+
+    @pytest.mark.parametrize('clone', ['make_clone', 'bulk_clone'])
+    def test_dotted_lookups_add_no_query_per_row(self, clone, patch_clone, song):
+        def count_queries():
+            with CaptureQueriesContext(connection) as ctx:
+                getattr(song.clone, clone)()
+            return len(ctx)
+
+        patch_clone(Song, many_to_one=[Param('songpart_set')])
+        for name in ('Intro', 'Verse', 'Outro'):
+            SongPart.objects.create(name=name, song=song)
+        plain = count_queries()
+
+        attrs = {'name': LookUp('song.album.artist.name')}
+        patch_clone(Song, many_to_one=[Param('songpart_set', attrs=attrs)])
+        assert count_queries() <= plain
+        assert set(SongPart.objects.values_list('name', flat=True)) == {'Intro', 'Verse', 'Outro', 'Les'}
+
+
+@pytest.mark.django_db
+class TestDependencyOrder:
+
+    @pytest.mark.parametrize('clone', ['make_clone', 'bulk_clone'])
+    def test_relations_declared_out_of_order(self, clone, patch_clone, album, song):
+        patch_clone(Artist, many_to_one=[Param('song_set'), Param('album_set')])
+        artist = album.artist
+
+        result = getattr(artist.clone, clone)()
+        cloned_artist = result if clone == 'make_clone' else result.get_clone(artist)
+        check_model_count(Album, 2)
+        check_model_count(Song, 2)
+        cloned_album = cloned_artist.album_set.get()
+        assert cloned_artist.song_set.get().album == cloned_album
+
+    def test_model_reached_twice_is_written_once(self, patch_clone, album, song):
+        patch_clone(Artist, many_to_one=[Param('song_set'), Param('album_set')])
+        patch_clone(Album, many_to_one=[Param('song_set', attrs={'title': 'From album'})])
+        artist = album.artist
+
+        plan = artist.clone.get_plan()
+        assert [plan_model.model for plan_model in plan] == [Artist, Album, Song]
+        assert [plan_model.level for plan_model in plan] == [0, 1, 2]
+
+        result = artist.clone.bulk_clone()
+        check_model_count(Song, 2)
+        cloned_song = result.get_clone(song)
+        assert cloned_song.album == result.get_clone(album)
+        assert cloned_song.artist == result.get_clone(artist)
+        # The attrs of both relations are merged.
+        assert cloned_song.title == 'From album'
+
+
+@pytest.mark.django_db
+class TestCyclicRelations:
+
+    @staticmethod
+    def make_chain(depth):
+        root = node = E.objects.create()
+        for _ in range(depth - 1):
+            node = E.objects.create(parent=node)
+        return root
+
+    def test_self_referential_tree(self, patch_clone):
+        patch_clone(E, many_to_one=[Param('children')])
+        root = self.make_chain(3)
+        E.objects.create(parent=root)
+        E.objects.create()  # Not in the subtree.
+
+        result = root.clone.bulk_clone()
+        check_model_count(E, 9)
+        cloned_root = result.get_clone(root)
+        assert cloned_root.parent is None
+        assert cloned_root.children.count() == 2
+        assert E.objects.filter(parent__parent__parent=cloned_root).count() == 0
+        assert E.objects.filter(parent__parent=cloned_root).count() == 1
+        assert set(result.mapping[E]) & set(result.mapping[E].values()) == set()
+
+    def test_self_referential_queries_do_not_grow_with_depth(self, patch_clone):
+        patch_clone(E, many_to_one=[Param('children')])
+
+        def count_queries(depth):
+            root = self.make_chain(depth)
+            with CaptureQueriesContext(connection) as ctx:
+                root.clone.bulk_clone()
+            return len(ctx)
+
+        assert count_queries(2) == count_queries(12)
+
+    def test_mutual_references(self, patch_clone):
+        patch_clone(F, many_to_one=[Param('g_set')])
+        f = F.objects.create()
+        featured = G.objects.create(f=f)
+        G.objects.create(f=f)
+        f.featured = featured
+        f.save()
+
+        plan = f.clone.get_plan()
+        assert [plan_model.model for plan_model in plan] == [F, G]
+        assert plan[F].deferred == [F._meta.get_field('featured')]
+
+        result = f.clone.bulk_clone()
+        cloned_f = result.get_clone(f)
+        assert cloned_f.g_set.count() == 2
+        assert cloned_f.featured == result.get_clone(featured)
+
+    def test_export_import_self_referential(self, patch_clone):
+        patch_clone(E, many_to_one=[Param('children')])
+        root = self.make_chain(4)
+
+        result = import_subtree(export_subtree(root.clone))
+        cloned_root = result.get_clone(root)
+        assert E.objects.filter(parent__parent__parent=cloned_root).count() == 1
+
+
+@pytest.mark.django_db
+class TestRestrictedRelations:
+
+    @staticmethod
+    def get_clone(obj, clone):
+        result = getattr(obj.clone, clone)()
+        return result if clone == 'make_clone' else result.get_clone(obj)
+
+    @pytest.mark.parametrize('clone', ['make_clone', 'bulk_clone'])
+    def test_filters(self, clone, patch_clone, album):
+        artist = album.artist
+        Album.objects.create(title='Pork Soda', artist=artist)
+        Album.objects.create(title='Frizzle Fry (live)', artist=artist)
+        patch_clone(Artist, many_to_one=[Param('album_set', filters={'title__startswith': 'Frizzle'})])
+
+        cloned_artist = self.get_clone(artist, clone)
+        assert sorted(cloned_artist.album_set.values_list('title', flat=True)) == ['Frizzle Fry', 'Frizzle Fry (live)']
+        check_model_count(Album, 5)
+
+    @pytest.mark.parametrize('clone', ['make_clone', 'bulk_clone'])
+    def test_limit_per_parent(self, clone, patch_clone, artist):
+        for title in ('Frizzle Fry', 'Pork Soda'):
+            album = Album.objects.create(title=title, artist=artist)
+            for song_title in ('A', 'B', 'C'):
+                Song.objects.create(title=f'{title} {song_title}', album=album, artist=artist)
+        patch_clone(Artist, many_to_one=[Param('album_set')])
+        patch_clone(Album, many_to_one=[Param('song_set', order_by=['-title'], limit=2, filters=~Q(title__endswith='C'))])
+
+        cloned_artist = self.get_clone(artist, clone)
+        assert sorted(Song.objects.filter(album__artist=cloned_artist).values_list('title', flat=True)) == [
+            'Frizzle Fry A', 'Frizzle Fry B', 'Pork Soda A', 'Pork Soda B',
+        ]
+
+    @pytest.mark.parametrize('clone', ['make_clone', 'bulk_clone'])
+    def test_only(self, clone, patch_clone, song):
+        artist = song.artist
+        patch_clone(Artist, many_to_one=[Param('song_set', only=['album'], attrs={'title': 'Lite'})])
+
+        with CaptureQueriesContext(connection) as ctx:
+            cloned_artist = self.get_clone(artist, clone)
+        cloned_song = cloned_artist.song_set.get()
+        assert cloned_song.title == 'Lite'
+        assert cloned_song.album == song.album
+        selects = [query['sql'] for query in ctx.captured_queries if query['sql'].startswith('SELECT')]
+        assert not any('"django_clone_helper_song"."title"' in sql for sql in selects)
+
+    @pytest.mark.parametrize('clone', ['make_clone', 'bulk_clone'])
+    def test_recursive(self, clone, patch_clone):
+        root = E.objects.create()
+        first, second = E.objects.create(parent=root), E.objects.create(parent=root)
+        first_children = [E.objects.create(parent=first), E.objects.create(parent=first)]
+        E.objects.create(parent=second)
+        patch_clone(E, many_to_one=[Param('children', order_by=['pk'], limit=1, filters=~Q(pk=first_children[0].pk))])
+
+        cloned_root = self.get_clone(root, clone)
+        check_model_count(E, 9)
+        cloned_child = E.objects.get(parent=cloned_root)
+        assert E.objects.filter(parent=cloned_child).count() == 1
+
+    def test_deferred_fields_are_read(self, artist, bass_guitar):
+        assert Artist.objects.only('id').get(pk=artist.pk).clone.make_clone().name == artist.name
+        BassGuitar.objects.update(type=BassGuitar.Type.ACOUSTIC)
+        source = BassGuitar.objects.only('name').get(pk=bass_guitar.pk)
+        assert source.clone.make_clone(attrs={'id': uuid4()}).type == BassGuitar.Type.ACOUSTIC
+
+
+@pytest.mark.django_db
+class TestCloneCommand:
+
+    @pytest.fixture
+    def artists(self, patch_clone):
+        patch_clone(Artist, many_to_one=[Param('album_set')])
+        for name in ('Les', 'Larry', 'Tim'):
+            artist = Artist.objects.create(name=name)
+            Album.objects.create(title=f'{name} album', artist=artist)
+
+    def test_dry_run(self, artists):
+        out = StringIO()
+        call_command('clone', 'django_clone_helper.Artist', '--filter', 'name__startswith=L', '--dry-run', stdout=out)
+        assert out.getvalue().splitlines() == [
+            'Would clone 4 rows:',
+            '  django_clone_helper.Artist: 2',
+            '  django_clone_helper.Album: 2',
+        ]
+        check_model_count(Artist, 3)
+
+    def test_clone(self, artists):
+        out = StringIO()
+        call_command('clone', 'django_clone_helper.Artist', '--batch-size', '1', '--validate', 'full', stdout=out)
+        lines = out.getvalue().splitlines()
+        assert lines[0].startswith('django_clone_helper.Artist: 1/6 rows')
+        assert lines[-2:] == ['  django_clone_helper.Artist: 3', '  django_clone_helper.Album: 3']
+        check_model_count(Artist, 6)
+        check_model_count(Album, 6)
+
+    def test_batches_of_roots(self, artists, monkeypatch):
+        runs = []
+        run = BulkCloner.run
+        monkeypatch.setattr(BulkCloner, 'run', lambda cloner: runs.append(cloner.roots) or run(cloner))
+        call_command('clone', 'django_clone_helper.Artist', '--batch-size', '2', verbosity=0)
+        assert [len(roots) for roots in runs] == [2, 1]
+        check_model_count(Album, 6)
+
+    def test_invalid_filter(self, artists):
+        with pytest.raises(CommandError):
+            call_command('clone', 'django_clone_helper.Artist', '--filter', 'name')
+
+
+@pytest.mark.django_db
+class TestUniqueStrategies:
+
+    def test_counter(self, patch_clone, instrument):
+        patch_clone(Instrument, unique_strategy=Counter(block_size=2), unique_field_prefix='-')
+
+        with CaptureQueriesContext(connection) as ctx:
+            serials = [instrument.clone.make_clone(attrs={'id': uuid4}).serial_number for _ in range(3)]
+        assert serials == ['1234ABC-1', '1234ABC-2', '1234ABC-3']
+        assert UniqueCounter.objects.get(label='django_clone_helper.instrument', field='serial_number').value == 4
+        updates = [query['sql'] for query in ctx.captured_queries if query['sql'].startswith('UPDATE')]
+        assert len(updates) == 2 and all('uniquecounter' in sql for sql in updates)
+
+    def test_counter_rollback(self, patch_clone, instrument):
+        patch_clone(Instrument, unique_strategy=Counter(block_size=10), unique_field_prefix='-')
+        with pytest.raises(IntegrityError):
+            with transaction.atomic():
+                assert instrument.clone.make_clone(attrs={'id': uuid4}).serial_number == '1234ABC-1'
+                raise IntegrityError
+        # The block is dropped with the reservation rolled back, instead of handing out 2.
+        assert instrument.clone.make_clone(attrs={'id': uuid4}).serial_number == '1234ABC-1'
+        assert UniqueCounter.objects.get().value == 10
+
+    def test_counter_bulk(self, patch_clone, instrument):
+        patch_clone(Instrument, unique_strategy=Counter())
+
+        with CaptureQueriesContext(connection) as ctx:
+            result = instrument.clone.bulk_clone()
+        assert result.get_clone(instrument).serial_number == '1234ABC-1'
+        assert not any('"serial_number" =' in query['sql'] for query in ctx.captured_queries)
+
+    def test_counter_separator(self, patch_clone, instrument):
+        other = Instrument.objects.create(id=uuid4(), name='bass', serial_number='1234ABC1')
+        patch_clone(Instrument, unique_strategy=Counter(block_size=20))
+        # Without a separator, the 1st clone of the other one and the 11th clone would both be 1234ABC11.
+        serials = [other.clone.bulk_clone().get_clone(other).serial_number]
+        serials += [instrument.clone.bulk_clone().get_clone(instrument).serial_number for _ in range(10)]
+        assert (serials[0], serials[-1]) == ('1234ABC1-1', '1234ABC-11')
+        with pytest.raises(ValueError):
+            Counter(separator='')
+        patch_clone(Instrument, unique_strategy=Counter(), unique_field_prefix='v1')
+        with pytest.raises(ValueError):
+            instrument.clone.make_clone(attrs={'id': uuid4})
+
+    def test_random_suffix_and_callable(self, patch_clone, instrument, bass_guitar):
+        patch_clone(Instrument, unique_strategy=RandomSuffix(length=8), unique_field_prefix='-')
+        serial_number = instrument.clone.make_clone(attrs={'id': uuid4}).serial_number
+        assert serial_number.startswith('1234ABC-') and len(serial_number) == 16
+
+        def copy_of(instance, field, prefix='', using=None):
+            return f'copy of {getattr(instance, field.attname)}'
+        patch_clone(Instrument, unique_strategy={'serial_number': copy_of})
+        assert instrument.clone.make_clone(attrs={'id': uuid4}).serial_number == 'copy of 1234ABC'
+
+
+@pytest.mark.django_db
+class TestOptimisticInsert:
+
+    @staticmethod
+    def suffixes(*values):
+        values = iter(values)
+
+        def strategy(instance, field, prefix='', using=None):
+            return f'{getattr(instance, field.attname)}{next(values)}'
+        return strategy
+
+    @pytest.mark.parametrize('clone', ['make_clone', 'bulk_clone'])
+    def test_retry_conflicting_rows(self, clone, patch_clone, instrument):
+        Instrument.objects.create(name='taken', serial_number='1234ABC-race')
+        patch_clone(Instrument, optimistic=True, unique_strategy=self.suffixes('-race', '-retry'))
+
+        getattr(instrument.clone, clone)(attrs={'id': uuid4})
+        assert Instrument.objects.filter(serial_number='1234ABC-retry').exists()
+
+    def test_only_conflicting_rows_are_retried(self, patch_clone):
+        Instrument.objects.create(name='taken', serial_number='S2')
+        patch_clone(Instrument, optimistic=True, unique_strategy=self.suffixes('1', '2', '3', '4'))
+        writer = BulkWriter('default')
+        pairs = [(index, Instrument(id=uuid4(), name='bass', serial_number='S')) for index in range(3)]
+
+        writer.write(Instrument, pairs)
+        assert sorted(Instrument.objects.filter(name='bass').values_list('serial_number', flat=True)) == ['S1', 'S3', 'S4']
+
+    def test_retries_are_bounded(self, patch_clone, instrument):
+        Instrument.objects.create(name='taken', serial_number='1234ABC-race')
+        patch_clone(Instrument, optimistic=True, unique_retries=1, unique_strategy=self.suffixes('-race', '-race'))
+
+        with pytest.raises(IntegrityError):
+            instrument.clone.bulk_clone()
+        check_model_count(Instrument, 2)
+
+
+@pytest.mark.django_db
+class TestCloneJobs:
+
+    def test_run_queued_job(self, patch_clone, album, song):
+        patch_clone(Artist, many_to_one=[Param('album_set'), Param('song_set')])
+        artist = album.artist
+        job = enqueue(artist, batch_size=1)
+        assert job.status == CloneJob.Status.PENDING
+
+        call_command('clone_worker', '--once')
+        job.refresh_from_db()
+        assert job.status == CloneJob.Status.DONE
+        assert (job.total, job.progress) == (3, 3)
+        cloned_artist = Artist.objects.get(pk=job.result['django_clone_helper.Artist'][str(artist.pk)])
+        assert cloned_artist.song_set.get().album == cloned_artist.album_set.get()
+
+    def test_failed_job(self, artist):
+        job = enqueue(artist)
+        artist.delete()
+
+        work(once=True)
+        job.refresh_from_db()
+        assert job.status == CloneJob.Status.FAILED
+        assert 'DoesNotExist' in job.error
+        assert claim() is None
+
+    def test_admin_action(self, admin_client, artist):
+        response = admin_client.post(
+            reverse('admin:django_clone_helper_artist_changelist'),
+            {'action': 'clone_selected', '_selected_action': [artist.pk]},
+        )
+        assert response.status_code == 302
+        job = CloneJob.objects.get()
+        assert job.source == artist
+        assert job.status == CloneJob.Status.PENDING
+
+
+@pytest.mark.django_db
+class TestCompiledInserts:
+
+    def test_statements_are_cached(self, patch_clone, artist):
+        for index in range(5):
+            Album.objects.create(title=f'Album {index}', artist=artist)
+        patch_clone(Artist, many_to_one=[Param('album_set')])
+
+        with CaptureQueriesContext(connection) as ctx:
+            result = artist.clone.bulk_clone(batch_size=2)
+        inserts = [query['sql'] for query in ctx.captured_queries if 'INSERT INTO "django_clone_helper_album"' in query['sql']]
+        # One statement per batch: two full ones through executemany, and the last row.
+        assert [sql.startswith('1 times: ') for sql in inserts] == [True, True, False]
+        assert ('default', Album, ('title', 'artist_id', 'cover'), 2, False) in InsertStatement.cache
+        cloned_artist = result.get_clone(artist)
+        assert sorted(cloned_artist.album_set.values_list('title', flat=True)) == [f'Album {index}' for index in range(5)]
+        assert sorted(result.mapping[Album].values()) == sorted(cloned_artist.album_set.values_list('pk', flat=True))
+
+        statement = InsertStatement.cache['default', Album, ('title', 'artist_id', 'cover'), 2, False]
+        artist.clone.bulk_clone(batch_size=2)
+        assert InsertStatement.cache['default', Album, ('title', 'artist_id', 'cover'), 2, False] is statement
+
+
+@pytest.mark.django_db
+class TestVerification:
+
+    def test_verify(self, patch_clone, album, song, bass_guitar):
+        for index in range(3):
+            Song.objects.create(title=f'Song {index}', album=album, artist=album.artist)
+        patch_clone(Artist, many_to_one=[Param('album_set', attrs={'title': 'Copy'}), Param('song_set')])
+        artist = album.artist
+        result = artist.clone.bulk_clone(batch_size=2)
+
+        checks = verify(artist.clone, result, batch_size=2)
+        assert [check.model for check in checks] == [Artist, Album, Song]
+        assert all(check.ok for check in checks)
+        assert checks[1].columns == []
+        assert checks[2].source == (4, checks[2].source[1])
+
+        cloned_song = result.get_clone(song)
+        Song.objects.filter(pk=cloned_song.pk).update(title='Changed')
+        checks = verify(artist.clone, result, batch_size=2)
+        assert [check.ok for check in checks] == [True, True, False]
+        assert checks[2].rows == [song.pk]
+
+        result = bass_guitar.clone.bulk_clone()
+        assert all(check.ok for check in verify(bass_guitar.clone, result))
+
+    def test_missing_clones(self, patch_clone, artist):
+        albums = [Album.objects.create(title=title, artist=artist) for title in ('One', 'Two')]
+        patch_clone(Artist, many_to_one=[Param('album_set')])
+        result = artist.clone.bulk_clone()
+        Album.objects.filter(pk=result.mapping[Album].pop(albums[1].pk)).delete()
+
+        album_check = verify(artist.clone, result)[1]
+        assert not album_check.ok
+        assert album_check.source[0] == 2 and album_check.clone[0] == 1
+        assert album_check.rows == [albums[1].pk]
+
+
+@pytest.mark.django_db
+class TestFileCopies:
+
+    @pytest.fixture
+    def cover(self, settings, tmp_path, album):
+        settings.MEDIA_ROOT = str(tmp_path)
+        album.cover.save('cover.txt', ContentFile(b'cover'))
+        return album.cover
+
+    @pytest.mark.parametrize('clone', ['make_clone', 'bulk_clone'])
+    def test_files_are_copied(self, clone, patch_clone, cover):
+        album = cover.instance
+        patch_clone(Artist, many_to_one=[Param('album_set')])
+
+        artist = TestRestrictedRelations.get_clone(album.artist, clone)
+        cloned_cover = artist.album_set.get().cover
+        assert cloned_cover.name != cover.name
+        assert cloned_cover.name.startswith('covers/cover_')
+        cover.delete()
+        with cloned_cover.open('rb') as fp:
+            assert fp.read() == b'cover'
+
+    @pytest.mark.parametrize('clone', ['make_clone', 'bulk_clone'])
+    def test_copies_of_failed_clones_are_deleted(self, clone, patch_clone, cover, song, tmp_path):
+        album = cover.instance
+        patch_clone(Artist, many_to_one=[Param('album_set'), Param('song_set', attrs={'title': 'x' * 101})])
+        options = {'validate': True} if clone == 'bulk_clone' else {}
+        with pytest.raises(ValidationError):
+            with transaction.atomic():
+                getattr(album.artist.clone, clone)(**options)
+        assert os.listdir(tmp_path / 'covers') == ['cover.txt']
+
+        with pytest.raises(ValidationError):
+            album.clone.make_clone(attrs={'title': 'x' * 101})
+        assert os.listdir(tmp_path / 'covers') == ['cover.txt']
+
+    def test_hardlinks_and_attrs(self, patch_clone, cover):
+        album = cover.instance
+        patch_clone(Album, file_copier=FileCopier(hardlinks=True))
+        cloned_album = album.clone.make_clone()
+        assert os.stat(cloned_album.cover.path).st_ino == os.stat(cover.path).st_ino
+
+        cloned_album = album.clone.make_clone(attrs={'cover': 'covers/other.txt'})
+        assert cloned_album.cover.name == 'covers/other.txt'
+
+    def test_parallel_copies(self, cover):
+        albums = [Album(title=str(index), artist=cover.instance.artist, cover=cover.name) for index in range(8)]
+        FileCopier(workers=4)(albums)
+        assert len({album.cover.name for album in albums} | {cover.name}) == 9
+
+
+@pytest.mark.django_db
+class TestUndoClone:
+
+    def test_undo_clone(self, patch_clone, passport, song, compilation):
+        artist = passport.owner
+        artist.tags.add(TaggedItem(tag='foo'), bulk=False)
+        patch_clone(Artist, one_to_one=[Param('passport')], many_to_one=[Param('album_set'), Param('song_set'), Param('tags')])
+        patch_clone(Song, many_to_many=[Param('compilation_set')])
+        result = artist.clone.bulk_clone()
+        counts = {model: model.objects.count() for model in (Artist, Passport, Album, Song, TaggedItem)}
+        assert Compilation.songs.through.objects.count() == 4
+
+        assert undo_clone(result) == result.counts
+        assert {model: model.objects.count() for model in counts} == {model: count // 2 for model, count in counts.items()}
+        assert Compilation.songs.through.objects.count() == 2
+
+    def test_undo_explicit_through(self, patch_clone, artist, group):
+        Membership.objects.create(person=artist, group=group, invite_reason='Bass')
+        patch_clone(Group, many_to_many=[Param('members')])
+        result = group.clone.bulk_clone()
+        check_model_count(Membership, 2)
+
+        assert undo_clone(result) == {'django_clone_helper.Group': 1}
+        check_model_count(Group, 1)
+        assert list(Membership.objects.values_list('group', flat=True)) == [group.pk]
+
+    def test_undo_cycles_and_inheritance(self, patch_clone, bass_guitar):
+        patch_clone(F, many_to_one=[Param('g_set')])
+        f = F.objects.create()
+        f.featured = G.objects.create(f=f)
+        f.save()
+        patch_clone(E, many_to_one=[Param('children')])
+        root = TestCyclicRelations.make_chain(3)
+        results = [f.clone.bulk_clone(), root.clone.bulk_clone(), bass_guitar.clone.bulk_clone()]
+
+        for result in results:
+            undo_clone(result)
+        assert [model.objects.count() for model in (E, F, G, BassGuitar, Instrument)] == [3, 1, 1, 1, 1]
+
+    def test_signals(self, song):
+        deleted = []
+
+        def receiver(sender, instance, **kwargs):
+            deleted.append(instance.pk)
+        post_delete.connect(receiver, sender=Song)
+        try:
+            result = song.clone.bulk_clone()
+            undo_clone(result)
+            assert deleted == [result.get(Song, song.pk)]
+            undo_clone(song.clone.bulk_clone(), send_signals=False)
+            assert len(deleted) == 1
+        finally:
+            post_delete.disconnect(receiver, sender=Song)
+        check_model_count(Song, 1)
+
+
+@pytest.mark.django_db
+class TestColumnarStaging:
+
+    def test_no_instances_are_built(self, patch_clone, album, song):
+        Song.objects.create(title='Bob', album=album, artist=album.artist)
+        patch_clone(Artist, many_to_one=[
+            Param('album_set', attrs={'title': LookUp('artist.name')}),
+            Param('song_set', attrs={'title': Batch(lambda rows: [row['title'].upper() for row in rows], fields=['title'])}),
+        ])
+        built = []
+
+        def receiver(sender, **kwargs):
+            built.append(sender)
+        pre_init.connect(receiver)
+        try:
+            result = album.artist.clone.bulk_clone(batch_size=1)
+        finally:
+            pre_init.disconnect(receiver)
+        assert Album not in built and Song not in built
+        cloned_artist = result.get_clone(album.artist)
+        cloned_album = cloned_artist.album_set.get()
+        assert cloned_album.title == 'Les'
+        assert sorted(cloned_artist.song_set.values_list('title', 'album')) == [
+            ('BOB', cloned_album.pk), ('MY NAME IS MUD', cloned_album.pk),
+        ]
+
+    def test_columns_instances(self, patch_clone, song):
+        patch_clone(Artist, many_to_one=[Param('song_set', attrs={'title': 'Staged'})])
+        cloner = BulkCloner(song.artist.clone.get_plan(), Artist.objects.all())
+        plan_model = cloner.plan[Song]
+        assert cloner.can_stage_columns(plan_model)
+
+        columns, = cloner.iter_columns(plan_model)
+        assert columns.source_pks == [song.pk]
+        staged, = columns.instances()
+        assert (staged.pk, staged.title, staged.album_id) == (None, 'Staged', song.album_id)
+
+
+    def test_generic_foreign_key_attr(self, patch_clone, artist):
+        artist.tags.add(TaggedItem(tag='foo'), bulk=False)
+        other = Artist.objects.create(name='Other')
+        patch_clone(Artist, many_to_one=[Param('tags', attrs={'content_object': other})])
+        cloner = BulkCloner(artist.clone.get_plan(), Artist.objects.filter(pk=artist.pk))
+        assert not cloner.can_stage_columns(cloner.plan[TaggedItem])
+
+        cloner.run()
+        assert [tag.content_object for tag in TaggedItem.objects.all()] == [artist, other]
+
+    @pytest.mark.parametrize('clone, attrs', [
+        ('make_clone', {}),
+        ('bulk_clone', {}),
+        ('bulk_clone', {'cover': LookUp('artist.set_album_title')}),
+    ])
+    def test_batch_fields_are_column_values(self, patch_clone, album, clone, attrs):
+        rows = []
+
+        def titles(batch_rows):
+            rows.extend(batch_rows)
+            return [row['title'] for row in batch_rows]
+        batch = Batch(titles, fields=['artist', 'title'])
+        patch_clone(Artist, many_to_one=[Param('album_set', attrs={'title': batch, **attrs})])
+        getattr(album.artist.clone, clone)()
+        assert rows == [{'artist': album.artist_id, 'title': album.title}]
+
+
+@pytest.mark.django_db
+class TestQueryBudget:
+
+    @staticmethod
+    def make_tree(patch_clone, rows):
+        a = A.objects.create()
+        for _ in range(rows):
+            b = B.objects.create(a=a)
+            D.objects.create(c=C.objects.create(b=b))
+        patch_clone(A, many_to_one=[Param('b_set')])
+        patch_clone(B, many_to_one=[Param('c_set')])
+        patch_clone(C, many_to_one=[Param('d_set')])
+        return a
+
+    @pytest.mark.parametrize('rows', [1, 10])
+    def test_bulk_clone_budget(self, patch_clone, query_budget, rows):
+        a = self.make_tree(patch_clone, rows)
+        with query_budget('3 * depth + 3', depth=4, rows=rows):
+            a.clone.bulk_clone()
+
+    @pytest.mark.parametrize('rows', [1, 10])
+    def test_make_clone_budget(self, patch_clone, query_budget, rows):
+        a = self.make_tree(patch_clone, rows)
+        with query_budget('4 * depth * rows + 2', depth=4, rows=rows):
+            a.clone.make_clone()
+
+    def test_budget_exceeded(self, patch_clone, query_budget):
+        a = self.make_tree(patch_clone, 2)
+        with pytest.raises(pytest.fail.Exception) as error:
+            with query_budget('depth', depth=1):
+                a.clone.make_clone()
+        assert 'over the budget depth = 1' in str(error.value)
+        assert 'django_clone_helper.B: ' in str(error.value)
+
+
+@pytest.mark.django_db
+class TestRelationPolicies:
+
+    @staticmethod
+    def clone(artist, method):
+        if method == 'make_clone':
+            return artist.clone.make_clone()
+        return BulkCloner(artist.clone.get_plan(), Artist.objects.filter(pk=artist.pk), validate=method == 'validate').run()
+
+    @pytest.mark.parametrize('method', ['make_clone', 'bulk_clone'])
+    def test_share(self, patch_clone, song, method):
+        patch_clone(Artist, many_to_one=[Param('album_set', policy=SHARE), Param('song_set')])
+        self.clone(song.artist, method)
+        check_model_count(Album, 1)
+        assert list(Song.objects.values_list('album', flat=True)) == [song.album_id, song.album_id]
+
+    @pytest.mark.parametrize('method', ['make_clone', 'bulk_clone', 'validate'])
+    def test_dedupe(self, patch_clone, song, method):
+        target = Artist.objects.create(name='Target')
+        existing = Album.objects.create(title=song.album.title, artist=target)
+        Album.objects.bulk_create([Album(title='Pork Soda', artist=song.artist) for _ in range(2)])
+        patch_clone(Artist, many_to_one=[
+            Param('album_set', attrs={'artist': target}, policy=DEDUPE), Param('song_set'),
+        ])
+        result = self.clone(song.artist, method)
+
+        assert sorted(target.album_set.values_list('title', flat=True)) == ['Frizzle Fry', 'Pork Soda']
+        cloned_song = Song.objects.exclude(pk=song.pk).get()
+        assert cloned_song.album_id == existing.pk
+        if method != 'make_clone':
+            assert result.get(Album, song.album_id) == existing.pk
+            undo_clone(result)
+            assert sorted(target.album_set.values_list('title', flat=True)) == ['Frizzle Fry']
+
+    def test_unknown_policy(self):
+        with pytest.raises(ValueError, match='Unknown policy'):
+            Param('album_set', policy='move')
+
+
+@pytest.fixture
+def sent_signals():
+    sent = []
+
+    def receiver(signal, sender, **kwargs):
+        sent.append((signal, sender, kwargs.get('pks')))
+    receivers = [pre_save, post_save, m2m_changed, clone_batch_created, clone_finished]
+    for signal in receivers:
+        signal.connect(receiver)
+    yield sent
+    for signal in receivers:
+        signal.disconnect(receiver)
+
+
+@pytest.mark.django_db
+class TestBatchSignals:
+
+    @pytest.mark.parametrize('method', ['make_clone', 'bulk_clone'])
+    def test_batched(self, patch_clone, compilation, sent_signals, method):
+        songs = list(Song.objects.all())
+        patch_clone(Album, many_to_one=[Param('song_set')], batch_signals=True)
+        patch_clone(Song, many_to_many=[Param('compilation_set')])
+        album = songs[0].album
+        getattr(album.clone, method)()
+
+        clone_pks = list(Song.objects.exclude(pk__in=[song.pk for song in songs]).values_list('pk', flat=True))
+        finished = [sender for signal, sender, _ in sent_signals if signal is clone_finished]
+        assert [(signal, sender, pks) for signal, sender, pks in sent_signals if signal is not clone_finished] == [
+            (clone_batch_created, Album, list(Album.objects.exclude(pk=album.pk).values_list('pk', flat=True))),
+            (clone_batch_created, Song, clone_pks),
+        ]
+        assert finished == [Album]
+        assert Compilation.songs.through.objects.count() == 4
+
+    def test_inherited_models(self, patch_clone, bass_guitar, sent_signals):
+        patch_clone(BassGuitar, batch_signals=True)
+        result = bass_guitar.clone.bulk_clone()
+        assert [(signal, sender) for signal, sender, _ in sent_signals] == [
+            (clone_batch_created, BassGuitar), (clone_finished, BassGuitar),
+        ]
+        assert result.get(BassGuitar, bass_guitar.pk) == BassGuitar.objects.exclude(pk=bass_guitar.pk).get().pk
+
+    def test_row_signals_by_default(self, album, sent_signals):
+        album.clone.make_clone()
+        assert [signal for signal, _, _ in sent_signals] == [pre_save, post_save]
+
+
+@pytest.mark.django_db
+class TestSnapshotClone:
+
+    def test_reads_before_writes(self, patch_clone, compilation):
+        patch_clone(Album, many_to_one=[Param('song_set')])
+        patch_clone(Song, many_to_many=[Param('compilation_set')])
+        album = Song.objects.first().album
+        with CaptureQueriesContext(connection) as ctx:
+            album.clone.bulk_clone(snapshot=True)
+        queries = [query['sql'] for query in ctx.captured_queries]
+        first_insert = next(i for i, sql in enumerate(queries) if sql.startswith('INSERT'))
+        last_read = max(i for i, sql in enumerate(queries) if 'compilation_songs' in sql and sql.startswith('SELECT'))
+        assert last_read < first_insert
+        assert Compilation.songs.through.objects.count() == 4
+
+    def test_staged_rows_are_written(self, patch_clone, song):
+        patch_clone(Album, many_to_one=[Param('song_set')])
+        cloner = BulkCloner(song.album.clone.get_plan(), Album.objects.all(), snapshot=True)
+        read = cloner.read
+
+        def read_then_update():
+            staged = read()
+            Song.objects.update(title='Changed')
+            return staged
+        cloner.read = read_then_update
+        result = cloner.run()
+        assert Song.objects.get(pk=result.get(Song, song.pk)).title == 'My name is mud'
+
+    def test_roots_are_read_in_snapshot(self, patch_clone, song):
+        patch_clone(Album, many_to_one=[Param('song_set')])
+        cloner = BulkCloner(song.album.clone.get_plan(), Album.objects.all(), snapshot=True)
+        assert 'roots' not in cloner.__dict__
+        album = Album.objects.create(title='Later', artist=song.album.artist)
+        assert album.pk in cloner.run().mapping[Album]
+
+    def test_enable_wal(self, tmp_path):
+        database = sqlite3.connect(str(tmp_path / 'db.sqlite3'))
+        cursor = database.cursor()
+        enable_wal(cursor)
+        assert cursor.execute('PRAGMA journal_mode').fetchone() == ('wal',)
+        database.close()
+
+    def test_enable_wal_fails(self):
+        cursor = Mock()
+        cursor.fetchone.side_effect = [('delete',), ('delete',)]
+        with pytest.raises(ImproperlyConfigured):
+            enable_wal(cursor)
+
+
+@pytest.mark.django_db(transaction=True)
+class TestDeferredClone:
+
+    def test_deferred(self, patch_clone, passport, song, compilation):
+        artist = passport.owner
+        patch_clone(Artist, one_to_one=[Param('passport')], many_to_one=[Param('album_set'), Param('song_set')])
+        patch_clone(Song, many_to_many=[Param('compilation_set')])
+        deferred = artist.clone.make_clone_deferred()
+        assert Passport.objects.filter(owner=deferred.instance).exists()
+
+        assert deferred.wait(timeout=10) == deferred.instance
+        assert deferred.done() and deferred.progress == (2, 2)
+        cloned_album = deferred.instance.album_set.get()
+        assert sorted(deferred.instance.song_set.values_list('album', flat=True)) == [cloned_album.pk] * 3
+        assert Compilation.songs.through.objects.count() == 4
+
+    def test_failed_branch(self, patch_clone, album):
+        patch_clone(Artist, many_to_one=[Param('album_set', attrs={'title': ''})])
+        deferred = album.artist.clone.make_clone_deferred()
+        with pytest.raises(ValidationError):
+            deferred.wait(timeout=10)
+        # The root of the failed clone is deleted.
+        check_model_count(Artist, 1)
+        check_model_count(Album, 1)
+
+
+class InlineExecutor(Executor):
+
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except Exception as error:
+            future.set_exception(error)
+        return future
+
+
+@pytest.mark.django_db
+class TestDeferredCloneInTransaction:
+
+    def test_started_on_commit(self, patch_clone, song):
+        patch_clone(Artist, many_to_one=[Param('album_set'), Param('song_set')])
+        deferred = song.artist.clone.make_clone_deferred(executor=InlineExecutor())
+        assert not deferred.done()
+        with pytest.raises(RuntimeError):
+            deferred.wait()
+        check_model_count(Album, 1)
+
+        # The test transaction never commits, run its on_commit callbacks.
+        for _, callback in connection.run_on_commit:
+            callback()
+        assert deferred.wait() == deferred.instance
+        assert deferred.instance.album_set.count() == 1
+        assert deferred.instance.song_set.get().album == deferred.instance.album_set.get()
+
+
+@pytest.mark.django_db
+class TestTemplateSnapshots:
+
+    @pytest.fixture
+    def template(self, patch_clone, compilation):
+        patch_clone(
+            Artist, many_to_one=[Param('album_set'), Param('song_set')], snapshot_cache=SnapshotCache(),
+        )
+        patch_clone(Song, many_to_many=[Param('compilation_set')])
+        return Artist.objects.get()
+
+    def test_stamp(self, template):
+        results = template.clone.stamp(n=3)
+        assert len({result.get(Artist, template.pk) for result in results}) == 3
+        check_model_count(Artist, 4)
+        check_model_count(Song, 8)
+        assert Compilation.songs.through.objects.count() == 8
+        for result in results:
+            cloned = result.get_clone(template)
+            album = cloned.album_set.get()
+            assert sorted(cloned.song_set.values_list('album', flat=True)) == [album.pk, album.pk]
+
+    def test_no_source_reads(self, template):
+        template.clone.stamp()
+        Album.objects.filter(artist=template).update(title='Changed')
+        result, = template.clone.stamp()
+        assert result.get_clone(template).album_set.get().title == 'Frizzle Fry'
+        result, = template.clone.stamp(version=2)
+        assert result.get_clone(template).album_set.get().title == 'Changed'
+
+    def test_instances_are_restaged(self, patch_clone, instrument):
+        patch_clone(Instrument, snapshot_cache=SnapshotCache())
+        results = instrument.clone.stamp(n=2)
+        assert len(set(Instrument.objects.values_list('serial_number', flat=True))) == 3
+        assert all(result.get(Instrument, instrument.pk) for result in results)
+
+    def test_eviction(self, artist, album):
+        cache = SnapshotCache(max_size=1)
+        other = Artist.objects.create(name='Larry')
+        first = cache.get(artist.clone)
+        assert cache.get(artist.clone) is first and first.size > 0
+        cache.get(other.clone)
+        assert len(cache.snapshots) == 1 and cache.get(artist.clone) is not first
+        cache.invalidate(artist)
+        assert not cache.snapshots
@@ -0,0 +1,127 @@
+"""
+Strategies making the unique fields of a clone unique.
+
+A strategy is any callable ``strategy(instance, field, prefix='', using=None)`` returning the
+new value of ``field`` for the clone ``instance``; ``prefix`` (the handler
+``unique_field_prefix``) goes between the current value and the generated suffix.
+"""
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from uuid import uuid4
+
+from django.db import connections, router, transaction
+
+from django_clone_helper.utils import generate_unique
+
+
+class Probe:
+    """Keep the value, or append the first counter not taken in the table (one query per attempt)."""
+
+    def __call__(self, instance, field, prefix='', using=None):
+        return generate_unique(instance, field, prefix=prefix, using=using)
+
+
+class RandomSuffix:
+    """Append ``length`` random hexadecimal characters, without querying the table."""
+
+    def __init__(self, length=12):
+        self.length = length
+
+    def __call__(self, instance, field, prefix='', using=None):
+        return f'{getattr(instance, field.attname)}{prefix}{uuid4().hex[:self.length]}'
+
+
+class Block:
+    """
+    Values reserved by Counter. A block reserved in a transaction is only used by its thread
+    until the transaction commits, and dropped when it rolls back: the values can then be
+    reserved again.
+    """
+
+    def __init__(self, start, stop, connection=None):
+        self.values = iter(range(start, stop))
+        self.connection = connection
+        self.thread = threading.current_thread()
+        if connection is not None:
+            transaction.on_commit(self.commit, using=connection.alias)
+
+    def commit(self):
+        self.connection = None
+
+    def is_valid(self):
+        if self.connection is None:
+            return True
+        # Django forgets the on_commit callbacks of the transactions and savepoints rolled back.
+        return threading.current_thread() is self.thread and any(
+            callback == self.commit for _, callback in self.connection.run_on_commit
+        )
+
+
+class Counter:
+    """
+    Append the next value of a per field counter. The counters are stored in the UniqueCounter
+    table and reserved ``block_size`` values at a time, so one query per block is needed.
+    The suffixes are only unique among the values generated by this strategy: the counter
+    follows the prefix, or ``separator`` when there is none, which must not end with a digit
+    ('SN' + '1' + '1' and 'SN1' + '1' would both give 'SN11').
+
+    Within a transaction, the blocks are reserved from another connection and committed at
+    once, so that the counter row is not locked until the clone commits. SQLite allows one
+    writer at a time: there, the blocks are reserved in the transaction and dropped if it
+    rolls back.
+    """
+
+    def __init__(self, block_size=100, separator='-'):
+        self.block_size = block_size
+        self.separator = self.check_separator(separator)
+        self.blocks = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def check_separator(separator):
+        if not separator or separator[-1].isdigit():
+            raise ValueError(f'The counter must follow a separator not ending with a digit, not {separator!r}.')
+        return separator
+
+    def reserve_values(self, key):
+        """Reserve the next ``block_size`` values of the counter, return their range bounds."""
+        from django_clone_helper.models import UniqueCounter
+
+        using, label, name = key
+        with transaction.atomic(using=using):
+            counter, _ = UniqueCounter.objects.using(using).select_for_update().get_or_create(label=label, field=name)
+            start = counter.value + 1
+            counter.value += self.block_size
+            counter.save(update_fields=['value'])
+        return start, counter.value + 1
+
+    def reserve_in_thread(self, key):
+        try:
+            return self.reserve_values(key)
+        finally:
+            connections.close_all()
+
+    def reserve(self, key, using):
+        connection = connections[using]
+        if not connection.in_atomic_block:
+            return Block(*self.reserve_values(key))
+        if connection.vendor != 'sqlite':
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                return Block(*executor.submit(self.reserve_in_thread, key).result())
+        return Block(*self.reserve_values(key), connection=connection)
+
+    def next(self, model, field, using):
+        key = (using, model._meta.label_lower, field.name)
+        with self.lock:
+            block = self.blocks.get(key)
+            value = next(block.values, None) if block is not None and block.is_valid() else None
+            if value is None:
+                block = self.blocks[key] = self.reserve(key, using)
+                value = next(block.values)
+        return value
+
+    def __call__(self, instance, field, prefix='', using=None):
+        model = field.model._meta.concrete_model
+        separator = self.check_separator(prefix or self.separator)
+        value = self.next(model, field, using or router.db_for_write(model))
+        return f'{getattr(instance, field.attname)}{separator}{value}'
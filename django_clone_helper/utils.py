@@ -1,14 +1,60 @@
 from collections import namedtuple
 from collections.abc import MutableMapping
+from itertools import islice
 
-from django.db.models import Model
+from django.contrib.contenttypes.fields import GenericForeignKey
+from django.core.exceptions import FieldDoesNotExist
+from django.db.models import Model, Q
+
+# Policies of the one_to_one and many_to_one relations, see Param.
+COPY = 'copy'
+SHARE = 'share'
+DEDUPE = 'dedupe'
 
 
 class Param(MutableMapping):
-    def __init__(self, name, attrs=None, exclude=None):
+    """
+    A relation to clone. ``filters`` (a dict of lookups or a Q), ``order_by``, ``only`` and
+    ``limit`` restrict the cloned rows of one_to_one and many_to_one relations in SQL; the
+    ``limit`` applies to the rows of each parent. Fields left out by ``only`` get their
+    default value on the clone; the primary key and the foreign keys are always read.
+
+    The ``policy`` of a one_to_one or many_to_one relation tells what happens to its rows:
+    COPY clones them, SHARE leaves them out of the clone (the clones pointing to them keep
+    pointing to the source rows) and DEDUPE reuses the existing row with the same content as
+    a clone, if any, instead of inserting it. The relations of shared and deduplicated rows
+    are not cloned.
+    """
+
+    def __init__(
+            self, name, attrs=None, exclude=None, filters=None, order_by=None, only=None, limit=None, policy=COPY
+    ):
+        if policy not in (COPY, SHARE, DEDUPE):
+            raise ValueError(f'Unknown policy {policy!r}.')
         self.name = name
         self.attrs = attrs or {}
         self.exclude = exclude
+        self.filters = filters or {}
+        self.order_by = order_by or []
+        self.only = only or []
+        self.limit = limit
+        self.policy = policy
+
+    @property
+    def condition(self):
+        return self.filters if isinstance(self.filters, Q) else Q(**self.filters)
+
+    def get_only(self, model):
+        """Return the fields to read, or an empty list to read them all."""
+        if not self.only:
+            return []
+        required = [field.name for field in model._meta.concrete_fields if field.primary_key or field.is_relation]
+        required += [field.fk_field for field in model._meta.private_fields if isinstance(field, GenericForeignKey)]
+        return sorted({*self.only, *required})
+
+    def get_defaults(self, model):
+        """Return the attnames of the fields left out by ``only``, that get their default value."""
+        return get_defaults(model, self.get_only(model))
 
     def __getitem__(self, item):
         return self.attrs[item]
@@ -26,7 +72,97 @@ class Param(MutableMapping):
         return len(self.attrs)
 
 
+def get_defaults(model, only):
+    """Return the attnames of the concrete fields of ``model`` not read with ``only``, if any."""
+    if not only:
+        return set()
+    return {field.attname for field in model._meta.concrete_fields if field.name not in only and field.attname not in only}
+
+
 LookUp = namedtuple('LookUp', ['name'])
+
+
+def get_related_path(model, name):
+    """
+    Return the ``select_related`` path of the relations crossed by the dotted ``name``
+    of a LookUp (e.g. ``album__artist`` for ``album.artist.name``), or None.
+    """
+    path = []
+    for part in name.split('.')[:-1]:
+        try:
+            field = model._meta.get_field(part)
+        except FieldDoesNotExist:
+            break
+        if not field.is_relation or not (field.many_to_one or field.one_to_one):
+            break
+        if not field.concrete and not field.one_to_one:
+            break
+        path.append(part)
+        model = field.related_model
+    return '__'.join(path) or None
+
+
+def get_lookup_path(model, name):
+    """
+    Return the ``values()`` path of a dotted LookUp name made of forward relations and a
+    concrete field (e.g. ``album__title`` for ``album.title``), or None.
+    """
+    parts = name.split('.')
+    for part in parts[:-1]:
+        try:
+            field = model._meta.get_field(part)
+        except FieldDoesNotExist:
+            return None
+        if not field.concrete or not field.is_relation or field.many_to_many:
+            return None
+        model = field.related_model
+    try:
+        field = model._meta.get_field(parts[-1])
+    except FieldDoesNotExist:
+        return None
+    return '__'.join(parts) if field.concrete else None
+
+
+def select_lookups(queryset, attrs):
+    """Join to ``queryset`` the relations crossed by the LookUp values of ``attrs``."""
+    paths = {get_related_path(queryset.model, value.name) for value in attrs.values() if isinstance(value, LookUp)}
+    paths.discard(None)
+    return queryset.select_related(*sorted(paths)) if paths else queryset
+
+
+class Batch(namedtuple('Batch', ['func', 'fields'], defaults=(None,))):
+    """
+    An attribute computed once for a whole batch of rows: ``func`` receives the list of
+    source instances, or the list of their ``fields`` values as dicts, and returns the
+    list of values in the same order. The values of the fields are their column values,
+    e.g. the primary key of the row a foreign key points to, see get_column_value().
+    """
+
+    def resolve(self, instances):
+        if self.fields is None:
+            return self.check(self.func(instances), instances)
+        return self.resolve_rows([{name: get_column_value(obj, name) for name in self.fields} for obj in instances])
+
+    def resolve_rows(self, rows):
+        """Resolve the attribute from ``rows``, the dicts of the ``fields`` values."""
+        return self.check(self.func(rows), rows)
+
+    def check(self, values, rows):
+        values = list(values)
+        if len(values) != len(rows):
+            raise ValueError(f'{self.func!r} returned {len(values)} values for {len(rows)} rows.')
+        return values
+
+
+def get_column_value(obj, name):
+    """Return the value of the column of the field ``name`` of ``obj``, or its ``name`` attribute."""
+    try:
+        field = obj._meta.get_field(name)
+    except FieldDoesNotExist:
+        return getattr(obj, name)
+    return getattr(obj, field.attname) if field.concrete else getattr(obj, name)
+
+
 Cloned = namedtuple('Cloned', ['name'])
 
 
@@ -38,15 +174,47 @@ def is_iterable(obj):
     return True
 
 
-def generate_unique(instance: Model, field):
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class CircularDependency(ValueError):
+    def __init__(self, items):
+        super().__init__(f'Circular dependency between {items!r}.')
+        self.items = items
+
+
+def toposort(items, depends_on):
+    """
+    Sort ``items`` so that each one comes after the items it depends on, keeping the given
+    order otherwise. ``depends_on(a, b)`` tells whether ``a`` depends on ``b``.
+    """
+    pending = list(items)
+    ordered = []
+    while pending:
+        for index, item in enumerate(pending):
+            if not any(other is not item and depends_on(item, other) for other in pending):
+                break
+        else:
+            raise CircularDependency(pending)
+        ordered.append(pending.pop(index))
+    return ordered
+
+
+def generate_unique(instance: Model, field, prefix='', using=None):
     Klass = instance.__class__
-    qs = Klass._default_manager
+    qs = Klass._default_manager.db_manager(using)
     value = getattr(instance, field.name)
     lookup = {field.name: value}
-    prefix = 1
+    counter = 1
     while qs.filter(**lookup).exists():
-        lookup[field.name] = value + str(prefix)
-        prefix += 1
+        lookup[field.name] = f'{value}{prefix}{counter}'
+        counter += 1
     return lookup[field.name]
 
 
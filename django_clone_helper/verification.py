@@ -0,0 +1,143 @@
+"""
+SQL side verification of a bulk clone.
+
+Each row is hashed by the database (MD5 of its compared columns) and the hashes are summed,
+so the source rows of a model (read from the plan, whether they were cloned or not) and its
+clone rows are compared with aggregate queries, whatever their order. The columns overridden
+by the attrs, remapped to the clones or regenerated (primary keys, unique, auto_now and
+copied file fields) are left out. Only the models that differ are compared per bucket of
+hashes, and only the buckets that differ row by row.
+"""
+import operator
+from functools import reduce
+
+from django.contrib.contenttypes.fields import GenericForeignKey
+from django.db.models import BigIntegerField, Count, ExpressionWrapper, FileField, Sum, TextField, Value
+from django.db.models.functions import Cast, Coalesce, Concat, MD5, StrIndex, Substr
+
+from django_clone_helper.bulk import DEFAULT_BATCH_SIZE, BulkCloner
+from django_clone_helper.utils import chunked
+
+HEX_DIGITS = '0123456789abcdef'
+# Hexadecimal digits of the row hashes summed: the sum of 2 ** 35 rows fits in 63 bits.
+CHECKSUM_DIGITS = 7
+
+
+class ModelCheck:
+    """The ``(count, checksum)`` of the source and clone rows of a model, and the differing source rows."""
+
+    def __init__(self, model, columns, source, clone, rows=None):
+        self.model = model
+        self.columns = columns
+        self.source = source
+        self.clone = clone
+        self.rows = rows or []
+
+    def __repr__(self):
+        return f'<ModelCheck {self.model._meta.label} {"ok" if self.ok else "differs"}>'
+
+    @property
+    def ok(self):
+        return self.source == self.clone
+
+
+def get_compared_fields(plan_model, result):
+    attrs = plan_model.param.attrs
+    ignored = {field.fk_field for field in plan_model.model._meta.private_fields if isinstance(field, GenericForeignKey)}
+    only = plan_model.only
+    fields = []
+    for field in plan_model.model._meta.concrete_fields:
+        if field.primary_key or field.unique or field.name in attrs or field.attname in attrs:
+            continue
+        if getattr(field, 'auto_now', False) or getattr(field, 'auto_now_add', False) or field.attname in ignored:
+            continue
+        if field.is_relation and field.related_model._meta.concrete_model in result.mapping:
+            continue
+        if isinstance(field, FileField) and plan_model.handler.file_copier is not None:
+            continue
+        if only and field.attname not in only and field.name not in only:
+            continue
+        fields.append(field)
+    return fields
+
+
+def hash_rows(queryset, fields):
+    parts = []
+    for field in fields:
+        parts += [Coalesce(Cast(field.attname, TextField()), Value('<null>')), Value('|')]
+    row_hash = MD5(Concat(*parts)) if parts else Value(HEX_DIGITS, output_field=TextField())
+    return queryset.order_by().annotate(row_hash=row_hash, bucket=Substr('row_hash', 1, 1))
+
+
+def checksum():
+    digits = [
+        (StrIndex(Value(HEX_DIGITS), Substr('row_hash', position + 1, 1)) - 1) * 16 ** (CHECKSUM_DIGITS - position - 1)
+        for position in range(CHECKSUM_DIGITS)
+    ]
+    return Sum(ExpressionWrapper(reduce(operator.add, digits), output_field=BigIntegerField()))
+
+
+def aggregate(querysets, fields, by_bucket=False):
+    """Sum the ``(count, checksum)`` of the queryset rows, per bucket when ``by_bucket``."""
+    totals = {}
+    for queryset in querysets:
+        queryset = hash_rows(queryset, fields)
+        if by_bucket:
+            rows = queryset.values('bucket').annotate(count=Count('pk'), checksum=checksum())
+            rows = rows.values_list('bucket', 'count', 'checksum')
+        else:
+            rows = [(None, *queryset.aggregate(count=Count('pk'), checksum=checksum()).values())]
+        for bucket, count, total in rows:
+            previous = totals.get(bucket, (0, 0))
+            totals[bucket] = (previous[0] + count, previous[1] + (total or 0))
+    return totals
+
+
+def verify(handler, result, batch_size=DEFAULT_BATCH_SIZE, **declarations):
+    """
+    Compare the rows of the subtree declared by ``handler`` (see make_clone for the
+    declarations) with their clones of the bulk clone ``result``, return a ModelCheck per model.
+    The source rows without a clone are reported as differing rows.
+    """
+    plan = handler.get_plan(**declarations)
+    cloner = BulkCloner(plan, handler.get_roots(), batch_size=batch_size)
+    checks = []
+    for plan_model in plan:
+        model = plan_model.model._meta.concrete_model
+        pairs = list({**result.reused.get(model, {}), **result.mapping.get(model, {})}.items())
+        clone_manager = plan_model.model._base_manager.using(handler.write_alias)
+        sources = [cloner.get_queryset(plan_model)]
+        clones = [clone_manager.filter(pk__in=[pk for _, pk in chunk]) for chunk in chunked(pairs, batch_size)]
+        fields = get_compared_fields(plan_model, result)
+        check = ModelCheck(
+            plan_model.model,
+            [field.attname for field in fields],
+            aggregate(sources, fields).get(None, (0, 0)),
+            aggregate(clones, fields).get(None, (0, 0)),
+        )
+        if not check.ok:
+            source_buckets = aggregate(sources, fields, by_bucket=True)
+            clone_buckets = aggregate(clones, fields, by_bucket=True)
+            buckets = [
+                bucket for bucket in {*source_buckets, *clone_buckets}
+                if source_buckets.get(bucket) != clone_buckets.get(bucket)
+            ]
+            check.rows = get_differing_rows(pairs, sources, clones, fields, buckets)
+        checks.append(check)
+    return checks
+
+
+def get_differing_rows(pairs, sources, clones, fields, buckets):
+    """Return the source primary keys, in the ``buckets``, without a clone or whose clone hash differs."""
+    def hashes(querysets):
+        return {
+            pk: row_hash for queryset in querysets
+            for pk, row_hash in hash_rows(queryset, fields).filter(bucket__in=buckets).values_list('pk', 'row_hash')
+        }
+    source_hashes, clone_hashes = hashes(sources), hashes(clones)
+    clone_pks = dict(pairs)
+    return [
+        source_pk for source_pk, clone_pk in pairs
+        if (source_pk in source_hashes or clone_pk in clone_hashes)
+        and source_hashes.get(source_pk) != clone_hashes.get(clone_pk)
+    ] + sorted(source_pk for source_pk in source_hashes if source_pk not in clone_pks)